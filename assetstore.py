@@ -0,0 +1,91 @@
+import os
+import os.path as op
+import json
+
+import util
+import filelayout
+import compress
+
+#
+# Auto-generated resources (such as equation images) are stored in
+# output_auto_generated_dir under the first 16 hex digits of the sha256 hash of
+# their contents, so each distinct file is stored once.
+#
+# 16 hexadecimal digits gives 16 ** 16 == 2 ** 64 possible hashes
+# Collisions are expected at around 2 ** 32 = 4 billion hashes
+#
+# The references file records which resources each target uses, so that
+# resources no longer used by any target can be deleted.
+#
+
+# Copies the file into the store, unless it is already there, and returns the
+# name it is stored under. The file is hashed first, so a file which is already
+# in the store (as most are, on a rebuild) is only read, not written.
+def store_file(source):
+    ext = op.splitext(source)[1]
+
+    name = util.sha256_file(source)[:16] + ext
+    target = filelayout.path_to_auto_resource(name)
+    if not op.isfile(target):
+        util.copy_atomic(source, target)
+
+    return name
+
+class References:
+    def __init__(self, path = None):
+        if path is None:
+            path = filelayout.asset_references_path
+        self.path = path
+        self.references = {}
+
+        if op.isfile(path):
+            with open(path, 'r') as f:
+                self.references = json.load(f)
+
+    def key(self, d):
+        return op.relpath(d.target_path, filelayout.output_dir)
+
+    def record(self, d):
+        self.references[self.key(d)] = sorted(d.assets)
+
+    def save(self):
+        util.write_atomic(self.path, lambda f : json.dump(self.references, f,
+            indent = 0, sort_keys = True))
+
+    # Forgets the targets which are not among the given documents, and deletes
+    # all stored files not referenced by the remaining ones. Returns the
+    # number of files deleted.
+    def collect_garbage(self, documents):
+        keys = set(self.key(d) for d in documents)
+
+        # A markdown document built before references were recorded may use
+        # files we don't know about
+        unknown = [d for d in documents if d.is_markdown and
+                not (self.key(d) in self.references)]
+        if len(unknown) > 0:
+            raise Exception("No record of the resources used by {} documents, "
+                    "such as {}; do a full build first".format(
+                        len(unknown), self.key(unknown[0])))
+
+        for key in list(self.references):
+            if key not in keys:
+                del self.references[key]
+
+        used = set()
+        for names in self.references.values():
+            used.update(names)
+
+        removed = 0
+        for name in os.listdir(filelayout.output_auto_generated_dir):
+            # Compressed versions go along with the original
+            base, ext = op.splitext(name)
+            if ext[1:] in compress.all_codecs:
+                name_used = base in used
+            else:
+                name_used = name in used
+
+            if not name_used:
+                os.remove(filelayout.path_to_auto_resource(name))
+                removed += 1
+
+        return removed
@@ -0,0 +1,81 @@
+#
+# Traversal of pandoc json, as done by pandocfilters.walk, but without
+# recursion and running any number of transforms in the same pass.
+#
+# A transform is a function
+#   transform(key, value)
+# called for each element (a dictionary {"t" : key, "c" : value}) that is an
+# item of a list, in document order. It returns None to leave the element as it
+# is, or otherwise an element or list of elements to replace it with. The
+# element may also be modified in place, which is cheaper than replacing it.
+#
+# The transforms are applied in the order they were registered, with each one
+# seeing the element as left by the one before. The children of the resulting
+# elements are then visited, exactly as with pandocfilters.walk.
+#
+
+def is_element(x):
+    return isinstance(x, dict) and 't' in x
+
+# Returns the list of elements to replace element with, or None if it is unchanged
+def apply_transforms(element, transforms):
+    elements = [element]
+    replaced = False
+    for transform in transforms:
+        result = []
+        for e in elements:
+            r = transform(e['t'], e.get('c'))
+            if r is None:
+                result.append(e)
+            else:
+                replaced = True
+                if isinstance(r, list):
+                    result.extend(r)
+                else:
+                    result.append(r)
+        elements = result
+
+    if replaced:
+        return elements
+    else:
+        return None
+
+# Each frame of the stack is [items, index, done, is_list], where items is a
+# list from the document (or the values of a dictionary, if not is_list), index
+# is the next item to visit and items before done have already been transformed.
+def visit(j, transforms):
+    stack = [[[j], 0, 1, False]]
+    while len(stack) > 0:
+        frame = stack[-1]
+        items, i, done, is_list = frame
+        if i >= len(items):
+            stack.pop()
+            continue
+
+        if is_list and i >= done and is_element(items[i]):
+            elements = apply_transforms(items[i], transforms)
+            if elements is not None:
+                items[i : i + 1] = elements
+                frame[2] = i + len(elements)
+                continue
+
+        item = items[i]
+        frame[1] = i + 1
+        if isinstance(item, list):
+            stack.append([item, 0, 0, True])
+        elif isinstance(item, dict):
+            stack.append([list(item.values()), 0, 0, False])
+
+    return j
+
+class Visitor:
+    def __init__(self):
+        self.transforms = []
+
+    def register(self, transform):
+        self.transforms.append(transform)
+
+    def run(self, j):
+        if len(self.transforms) > 0:
+            visit(j, self.transforms)
+        return j
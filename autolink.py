@@ -0,0 +1,155 @@
+import re
+import os.path as op
+import urllib.parse
+
+import filelayout
+
+#
+# Turning the bare URLs in the text of posts imported from social media into
+# markdown: images are shown, links to known sites are given the name of the
+# site, and anything else becomes an automatic link.
+#
+# Sites are looked up by hostname, so that a link is only named after a site if
+# it is actually on that site (and not, say, a link which mentions the site in
+# its path). A site also covers its subdomains: 'wikipedia.org' matches
+# en.wikipedia.org. Looking up a hostname takes one dictionary lookup per
+# label, regardless of how many sites there are.
+#
+# More sites can be given in filelayout.link_names_path, one per line as
+#   hostname    Name of the site
+# where blank lines and lines starting with '#' are ignored. These are added to
+# (or replace) the default_sites below.
+#
+
+default_sites = {
+            'wikipedia.org' : 'Wikipedia',
+            'theguardian.com' : 'The Guardian',
+            'bbc.com' : 'BBC',
+            'bbc.co.uk' : 'BBC',
+            'telegraph.co.uk' : 'The Telegraph',
+            'nytimes.com' : 'NYT',
+            'slate.com' : 'Slate',
+            'washingtonpost.com' : 'Washington Post',
+            'newyorker.com' : 'The New Yorker',
+            'theatlantic.com' : 'The Atlantic',
+            'pnas.org' : 'PNAS',
+            'youtube.com' : 'YouTube',
+            'vox.com' : 'Vox',
+            'lawfareblog.com' : 'Lawfare',
+            'openargs.com' : 'Opening Arguments',
+            'fivethirtyeight.com' : '538',
+            'cnn.com' : 'CNN'
+        }
+
+# Sites whose pages may end in an image extension without being images
+not_images = set(['wikipedia.org'])
+
+image_extensions = ('.png', '.jpg', '.jpeg')
+
+# A URL is ended by whitespace or by characters which can't be part of one. URLs
+# which are already part of markdown or html, such as [text](url), <url> or
+# src="url", are left alone.
+url_pattern = re.compile(r'''(?<![(<\["'=])\bhttps?://[^\s<>"]+''', re.IGNORECASE)
+
+# Punctuation which ends a sentence rather than the URL
+trailing_punctuation = '.,;:!?\'"'
+
+def read_sites(path):
+    sites = {}
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            split = line.split(maxsplit = 1)
+            if len(split) != 2:
+                raise ValueError("Expected a hostname and a name in {}: \"{}\"".format(
+                    path, line))
+            sites[split[0].lower().rstrip('.')] = split[1]
+    return sites
+
+class SiteTable:
+    def __init__(self, sites):
+        self.sites = dict(sites)
+
+    # Returns the site hostname belongs to, the longest matching suffix of whole
+    # labels, or None
+    def find(self, hostname):
+        labels = hostname.lower().rstrip('.').split('.')
+        for i in range(len(labels)):
+            suffix = '.'.join(labels[i:])
+            if suffix in self.sites:
+                return suffix
+        return None
+
+    def name(self, hostname):
+        site = self.find(hostname)
+        if site is None:
+            return None
+        return self.sites[site]
+
+table = None
+
+def get_table():
+    global table
+    if table is None:
+        sites = dict(default_sites)
+        if op.isfile(filelayout.link_names_path):
+            sites.update(read_sites(filelayout.link_names_path))
+        table = SiteTable(sites)
+    return table
+
+# Makes the table be read again, after the file has changed
+def reset():
+    global table
+    table = None
+
+# Splits a match of url_pattern into the URL and any punctuation after it
+def split_url(text):
+    end = len(text)
+    while end > 0:
+        c = text[end - 1]
+        if c in trailing_punctuation:
+            end -= 1
+        elif c == ')' and text.count('(', 0, end) < text.count(')', 0, end):
+            end -= 1
+        else:
+            break
+    return text[:end], text[end:]
+
+def hostname(url):
+    try:
+        return urllib.parse.urlsplit(url).hostname or ''
+    except ValueError:
+        return ''
+
+# Returns the markdown for url. alone is set if it is the whole line.
+def link_markdown(url, alone, sites):
+    host = hostname(url)
+    site = sites.find(host)
+
+    is_image = url.lower().endswith(image_extensions) and not (site in not_images)
+    if is_image:
+        if alone:
+            return '![]({}){{.image_center}}'.format(url)
+        else:
+            return '![]({}){{.image}}'.format(url)
+    elif site is not None:
+        return '[{}]({})'.format(sites.sites[site], url)
+    else:
+        return '<{}>'.format(url)
+
+def auto_link(line):
+    if not ('http' in line.lower()):
+        return line
+
+    sites = get_table()
+    alone = (len(line.split()) == 1)
+
+    def replace(match):
+        url, rest = split_url(match.group(0))
+        if len(url) == 0:
+            return match.group(0)
+        return link_markdown(url, alone, sites) + rest
+
+    return url_pattern.sub(replace, line)
@@ -1,8 +1,8 @@
 import os
-import os.path as op
 
 import document
 import filelayout
+import autolink
 
 months = [
             'January', 'February', 'March', 'April', 'May', 'June',
@@ -34,7 +34,6 @@ class BlogPost:
         self.newer = None
         self.name_postfix = ''
         self.tags = []
-        self.modtime = None
 
         self.document = None
 
@@ -88,10 +87,12 @@ class BlogPost:
         d.name = self.name
         d.source_data = self.markdown
         d.set_target_path(filelayout.blog_target_path(self.name))
-        d.modtime = self.modtime
         d.is_markdown = True
         d.template = filelayout.pandoc_blog_template
 
+        # The body is included in the expanded index for its year
+        d.make_fragment = True
+
         date_human = date_human_readable(*self.date)
 
         if self.title is None:
@@ -104,63 +105,8 @@ class BlogPost:
         if len(self.tags) > 0:
             d.add_variable('tagline', self.tagline())
 
-        if self.newer is not None:
-            d.modtime = max(d.modtime, self.newer.modtime)
-        if self.older is not None:
-            d.modtime = max(d.modtime, self.older.modtime)
-
-
-
-
-linknames = {
-            'wikipedia.org' : 'Wikipedia',
-            'theguardian.com' : 'The Guardian',
-            'bbc.com' : 'BBC',
-            'bcc.co.uk' : 'BBC',
-            'telegraph.co.uk' : 'The Telegraph',
-            'nytimes.com' : 'NYT',
-            'slate.com' : 'Slate',
-            'washingtonpost.com' : 'Washington Post',
-            'newyorker.com' : 'The New Yorker',
-            'theatlantic.com' : 'The Atlantic',
-            'pnas.org' : 'PNAS',
-            'youtube.com' : 'YouTube',
-            'vox.com' : 'Vox',
-            'lawfareblog.com' : 'Lawfare',
-            'openargs.com' : 'Opening Arguments',
-            'fivethirtyeight.com' : '538',
-            'cnn.com' : 'CNN'
-        }
-
-def auto_link(line):
-    if line.startswith('http'):
-        split = line.split(maxsplit = 1)
-        if len(split) == 1:
-            url = split[0]
-            rest = ''
-        else:
-            url = split[0]
-            rest = ' ' + split[1]
-
-        ul = url.lower()
-        is_image = ul.endswith('.png') or ul.endswith('.jpg') or ul.endswith('.jpeg')
-        if 'wikipedia' in ul:
-            is_image = False
-
-        if is_image:
-            # return '![]({}){{max-width=100%}}{}'.format(url, rest)
-            if len(rest) == 0:
-                return '![]({}){{.image_center}}'.format(url)
-            else:
-                return '![]({}){{.image}}{}'.format(url, rest)
-        else:
-            for keyword in linknames:
-                if keyword in url:
-                    return '[{}]({}){}'.format(linknames[keyword], url, rest)
 
-            return '<{}>{}'.format(url, rest)
-    else:
-        return line
+
 
 esc = set('\\`*_{}[]()<>#+-.!()$%^&=|:;"\',/~')
 def escape_markdown(text):
@@ -172,63 +118,125 @@ def escape_markdown(text):
             res.append(c)
     return ''.join(res)
 
+# Returns the post made from the header and body lines of a block of a .blog
+# file, or None if the block has no body or no date
+def make_post(source, headers, body):
+    if ('facebook' in source) or ('gtalk' in source):
+        body = [autolink.auto_link(line) for line in body]
+
+    body = '\n'.join(body).strip()
+    if len(body) == 0:
+        return None
+
+    post = BlogPost.from_source_text(headers, body)
+    if 'facebook' in source:
+        post.parse_header_tag('facebook')
+    if 'gtalk' in source:
+        post.parse_header_tag('gtalk')
+
+    if post.date is None:
+        print("Blog post missing date!")
+        print(">>{}<<>>{}<<".format('@'.join(headers), body))
+        return None
+    return post
+
+# Yields the posts in a .blog file one by one, reading it a line at a time so
+# that only one block is held in memory.
+#
+# A block starts with a line beginning with '@' which follows a line that
+# doesn't; its lines beginning with '@' are headers and the others the body.
+def iter_posts(source):
+    h = '@'
+
+    with open(source, 'r') as f:
+        headers = []
+        body = []
+        previous_header = False
+        for line in f:
+            line = line.rstrip('\n')
+            is_header = line.startswith(h)
+
+            if is_header and not previous_header and (len(headers) + len(body) > 0):
+                post = make_post(source, headers, body)
+                if post is not None:
+                    yield post
+                headers = []
+                body = []
+            previous_header = is_header
+
+            if is_header:
+                line = line[1:].strip()
+                if len(line) > 0:
+                    headers.append(line)
+            else:
+                body.append(line)
+
+    post = make_post(source, headers, body)
+    if post is not None:
+        yield post
+
+# Returns the list of posts in a .blog file
+def read_posts(source):
+    return list(iter_posts(source))
+
 collision_postfix = 'abcdefghijklmnopqrstuvwxyz'
 
+# Limits on the size of a page of the expanded index: a year with more posts,
+# or more bytes of markdown in its posts, is split over several pages. None
+# for no limit. A page always has at least one post.
+index_page_posts = None
+index_page_bytes = None
+
+# Settings which affect the documents made for every post
+def site_settings():
+    return [index_page_posts, index_page_bytes]
+
+# Splits the list of posts into pages within the limits
+def paginate(posts, max_posts = None, max_bytes = None):
+    pages = []
+    page = []
+    size = 0
+    for post in posts:
+        post_size = len(post.markdown.encode('utf8'))
+        full = (max_posts is not None and len(page) >= max_posts) or \
+                (max_bytes is not None and size + post_size > max_bytes)
+        if len(page) > 0 and full:
+            pages.append(page)
+            page = []
+            size = 0
+        page.append(post)
+        size += post_size
+    if len(page) > 0:
+        pages.append(page)
+    return pages
+
+# The posts of a blog grouped in the ways the listing pages need, made in a
+# single pass over the posts, which must be sorted from oldest to newest.
+# Each group lists its posts from newest to oldest.
+class BlogIndex:
+    def __init__(self, posts):
+        self.by_year = {}
+        self.by_tag = {}
+        self.by_date = {}
+
+        for post in reversed(posts):
+            self.by_year.setdefault(post.date[0], []).append(post)
+            self.by_date.setdefault(post.date, []).append(post)
+            for tag in post.tags:
+                self.by_tag.setdefault(tag, []).append(post)
+
+        self.years = sorted(self.by_year, reverse = True)
+
 class Blog:
     def __init__(self):
         self.posts = []
         self.years = None
-        self.modtime = 0
+        self.index = None
+        self.pages = None
 
     def read_from_file(self, source):
-        modtime = op.getmtime(source)
-        self.modtime = max(self.modtime, modtime)
-
-        h = '@'
-        is_social = ('facebook' in source) or ('gtalk' in source)
-
-        with open(source, 'r') as f:
-            lines = f.read().split('\n')
-
-        blocks = []
-
-        start = 0
-        for i in range(1, len(lines)):
-            if lines[i].startswith(h) and (not lines[i - 1].startswith(h)):
-                blocks.append(lines[start : i])
-                start = i
-        blocks.append(lines[start : ])
-
-        for block in blocks:
-            headers = []
-            body = []
-            for line in block:
-                if line.startswith(h):
-                    line = line[1:].strip()
-                    if len(line) > 0:
-                        headers.append(line)
-                else:
-                    body.append(line)
-
-            if is_social:
-                for i in range(len(body)):
-                    body[i] = auto_link(body[i])
-
-            body = '\n'.join(body).strip()
-
-            if len(body) > 0:
-                post = BlogPost.from_source_text(headers, body)
-                post.modtime = modtime
-                if 'facebook' in source:
-                    post.parse_header_tag('facebook')
-                if 'gtalk' in source:
-                    post.parse_header_tag('gtalk')
-
-                if post.date is None:
-                    print("Blog post missing date!")
-                    print(">>{}<<>>{}<<".format('@'.join(headers), body))
-                else:
-                    self.posts.append(post)
+        for post in iter_posts(source):
+            self.posts.append(post)
 
     def sort_and_name(self):
         # Note that "sort" is guaranteed to be stable, so if there are multiple
@@ -237,24 +245,34 @@ class Blog:
         # file so that their relative order can be guaranteed.
 
         self.posts = list(filter(lambda p : not ('hidden' in p.tags), self.posts))
+
+        # Posts may be kept from an earlier build (see watch mode)
+        for post in self.posts:
+            post.newer = None
+            post.older = None
+            post.name_postfix = ''
+
         self.posts.reverse()
         self.posts.sort(key = lambda p : p.date)
 
         n = len(self.posts)
-        collisions = [False] * n
         for i in range(n - 1):
             self.posts[i].newer = self.posts[i + 1]
             self.posts[i + 1].older = self.posts[i]
-            collisions[i] = (self.posts[i + 1].date == self.posts[i].date)
 
-        collision_index = 0
-        for i in range(n - 1):
-            if collisions[i]:
-                self.posts[i].name_postfix = collision_postfix[collision_index]
-                self.posts[i + 1].name_postfix = collision_postfix[collision_index + 1]
-                collision_index += 1
-            else:
-                collision_index = 0
+        self.index = BlogIndex(self.posts)
+        self.years = self.index.years
+
+        self.pages = {}
+        for year in self.years:
+            self.pages[year] = paginate(self.index.by_year[year],
+                    index_page_posts, index_page_bytes)
+
+        # Posts with the same date are told apart by a letter, the oldest first
+        for posts in self.index.by_date.values():
+            if len(posts) > 1:
+                for i, post in enumerate(reversed(posts)):
+                    post.name_postfix = collision_postfix[i]
 
         for post in self.posts:
             post.name = post.date_string + post.name_postfix
@@ -266,11 +284,25 @@ class Blog:
             if post.older is not None:
                 post.document.add_variable('older', post.older.name)
 
-        self.years = []
-        for p in self.posts:
-            if not (p.date[0] in self.years):
-                self.years.append(p.date[0])
-        self.years.sort(reverse = True)
+    # Appends to markdown a table with a line for each of the posts. If
+    # with_year is not set, the dates are shown without the year.
+    def index_table(self, markdown, posts, with_year = False):
+        markdown.append('|  |  |')
+        markdown.append('|{}:|:{}|'.format('-' * 12, '-' * 80))
+        for p in posts:
+            if with_year:
+                date = date_human_readable(*p.date)
+            else:
+                date = date_human_readable(None, p.date[1], p.date[2])
+            if p.title is None:
+                # tease = '``` ' + p.markdown[:60].replace('\n', ' ') + ' ```'
+                tease = escape_markdown(p.markdown[:70].replace('\n', ' '))
+            else:
+                tease = p.title
+            line = '|[{}]({}){{.indexdate}}|[{}]({}){{.tease}}|'.format(
+                    date, p.name, tease, p.name)
+            markdown.append(line)
+        markdown.append('')
 
     def make_index_compact(self):
         markdown = []
@@ -279,29 +311,28 @@ class Blog:
         markdown.append(line)
         markdown.append('')
 
-        for y in self.years:
-            markdown.append('## [{}](index_{}) {{#year_{}}}'.format(y, y, y))
+        tags = [tag for tag, tag_display in alltags if tag in self.index.by_tag]
+        if len(tags) > 0:
+            line = ' '.join(["[{}](tag_{})".format(tag, tag) for tag in tags])
+            markdown.append('Tags: ' + line)
             markdown.append('')
-            markdown.append('|  |  |')
-            markdown.append('|{}:|:{}|'.format('-' * 12, '-' * 80))
-            for p in reversed(self.posts):
-                if p.date[0] == y:
-                    date = date_human_readable(None, p.date[1], p.date[2])
-                    if p.title is None:
-                        # tease = '``` ' + p.markdown[:60].replace('\n', ' ') + ' ```'
-                        tease = escape_markdown(p.markdown[:70].replace('\n', ' '))
-                    else:
-                        tease = p.title
-                    line = '|[{}]({}){{.indexdate}}|[{}]({}){{.tease}}|'.format(
-                            date, p.name, tease, p.name)
-                    markdown.append(line)
+
+        for y in self.years:
+            markdown.append('## [{}]({}) {{#year_{}}}'.format(
+                y, filelayout.blog_index_expanded_name(y), y))
             markdown.append('')
+            if len(self.pages[y]) > 1:
+                line = ' '.join(["[{}]({})".format(page + 1,
+                    filelayout.blog_index_expanded_name(y, page))
+                    for page in range(len(self.pages[y]))])
+                markdown.append('Pages: ' + line)
+                markdown.append('')
+            self.index_table(markdown, self.index.by_year[y])
 
         d = document.WebDocument()
         d.name = 'index.html.md'
         d.set_target_path(filelayout.output_blog_index_compact)
         d.source_data = '\n'.join(markdown)
-        d.modtime = self.modtime
         d.is_markdown = True
         d.template = filelayout.pandoc_blog_compact_template
 
@@ -309,45 +340,77 @@ class Blog:
 
         return d
 
-    def make_index_expanded(self, year):
-        markdown = []
-
-        modtime = 0
+    # The bodies of the posts are not rendered again, but included from the html
+    # made for the pages of the posts, so only the headings are new markdown.
+    #
+    # The pages of a year are chained together by the newer and older links,
+    # with the first page of a year following the last page of the next year.
+    def make_index_expanded(self, year, page = 0):
+        parts = []
+
+        for p in self.pages[year][page]:
+            markdown = []
+            date = date_human_readable(*p.date)
+            if p.title is None:
+                markdown.append('## [{}]({})'.format(date, p.name))
+                markdown.append('')
+            else:
+                markdown.append('## [{}]({})'.format(p.title, p.name))
+                markdown.append('')
+                markdown.append('[{}]{{.date}}'.format(date))
+                markdown.append('')
 
-        for p in reversed(self.posts):
-            if p.date[0] == year:
-                date = date_human_readable(*p.date)
-                if p.title is None:
-                    markdown.append('## [{}]({})'.format(date, p.name))
-                    markdown.append('')
-                else:
-                    markdown.append('## [{}]({})'.format(p.title, p.name))
-                    markdown.append('')
-                    markdown.append('[{}]{{.date}}'.format(date))
-                    markdown.append('')
-
-                if len(p.tags) > 0:
-                    markdown.append('[{}]{{.tagline}}'.format(p.tagline()))
-                    markdown.append('')
-
-                markdown.append(p.markdown)
+            if len(p.tags) > 0:
+                markdown.append('[{}]{{.tagline}}'.format(p.tagline()))
                 markdown.append('')
 
-                modtime = max(modtime, p.modtime)
+            parts.append('\n'.join(markdown))
+            parts.append(p.document)
 
         d = document.WebDocument()
-        d.name = 'index_{}.md'.format(year)
-        d.set_target_path(filelayout.blog_index_expanded_path(year))
-        d.source_data = '\n'.join(markdown)
-        d.modtime = modtime
+        d.name = filelayout.blog_index_expanded_name(year, page) + '.md'
+        d.set_target_path(filelayout.blog_index_expanded_path(year, page))
+        d.parts = parts
         d.is_markdown = True
         d.template = filelayout.pandoc_blog_expanded_template
 
-        d.add_variable('pagetitle', 'Blog - {}'.format(year))
-        if year + 1 in self.years:
-            d.add_variable('newer', 'index_{}'.format(year + 1))
-        if year - 1 in self.years:
-            d.add_variable('older', 'index_{}'.format(year - 1))
+        pages = len(self.pages[year])
+        if pages == 1:
+            d.add_variable('pagetitle', 'Blog - {}'.format(year))
+        else:
+            d.add_variable('pagetitle', 'Blog - {} ({} of {})'.format(year, page + 1, pages))
+
+        if page > 0:
+            d.add_variable('newer', filelayout.blog_index_expanded_name(year, page - 1))
+        elif year + 1 in self.pages:
+            d.add_variable('newer', filelayout.blog_index_expanded_name(year + 1,
+                len(self.pages[year + 1]) - 1))
+        if page + 1 < pages:
+            d.add_variable('older', filelayout.blog_index_expanded_name(year, page + 1))
+        elif year - 1 in self.pages:
+            d.add_variable('older', filelayout.blog_index_expanded_name(year - 1))
+
+        return d
+
+    # Lists the posts with one of the tags in alltags, or None if there are none
+    def make_index_tag(self, tag, tag_display):
+        posts = self.index.by_tag.get(tag, [])
+        if len(posts) == 0:
+            return None
+
+        markdown = []
+        markdown.append('Posts {}.'.format(tag_display))
+        markdown.append('')
+        self.index_table(markdown, posts, with_year = True)
+
+        d = document.WebDocument()
+        d.name = 'tag_{}.md'.format(tag)
+        d.set_target_path(filelayout.blog_tag_index_path(tag))
+        d.source_data = '\n'.join(markdown)
+        d.is_markdown = True
+        d.template = filelayout.pandoc_blog_compact_template
+
+        d.add_variable('pagetitle', 'Blog - {}'.format(tag))
 
         return d
 
@@ -357,6 +420,11 @@ class Blog:
         docs = [post.document for post in self.posts]
         docs.append(self.make_index_compact())
         for year in self.years:
-            docs.append(self.make_index_expanded(year))
+            for page in range(len(self.pages[year])):
+                docs.append(self.make_index_expanded(year, page))
+        for tag, tag_display in alltags:
+            d = self.make_index_tag(tag, tag_display)
+            if d is not None:
+                docs.append(d)
 
         return docs
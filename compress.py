@@ -0,0 +1,132 @@
+import os
+import os.path as op
+import gzip
+import mimetypes
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#
+# Precompression of the website files, so that the web server can send a
+# compressed version of a file without spending any CPU on it. For a file
+# foo, the compressed versions are foo.gz, foo.br and foo.zst.
+#
+# brotli and zstd are only available if the corresponding python modules are
+# installed.
+#
+
+# Compression level for each codec. Codecs which are left out are not used.
+levels = {'gz' : 9}
+if brotli is not None:
+    levels['br'] = 11
+if zstandard is not None:
+    levels['zst'] = 19
+
+all_codecs = ['gz', 'br', 'zst']
+
+# Files smaller than this are not worth compressing
+min_size = 500
+
+# A compressed version is only kept if it is at most this fraction of the size
+# of the original
+max_ratio = 0.9
+
+# Files with these MIME types are already compressed
+incompressible_types = {
+        'application/gzip', 'application/zip', 'application/pdf',
+        'application/x-bzip2', 'application/x-xz', 'application/zstd',
+        'font/woff', 'font/woff2'
+    }
+incompressible_prefixes = ['image/', 'audio/', 'video/']
+
+# Parses a specification such as "gz:9,br" (default levels are used where no
+# level is given) and sets the codecs and levels to use
+def configure(spec):
+    new_levels = {}
+    for part in spec.split(','):
+        if len(part) == 0:
+            continue
+        name, _, level = part.partition(':')
+        if name not in all_codecs:
+            raise ValueError("Unknown compression codec \"{}\".".format(name))
+        if (name == 'br' and brotli is None) or (name == 'zst' and zstandard is None):
+            raise ValueError("Python module for codec \"{}\" is not installed.".format(name))
+        if len(level) == 0:
+            level = {'gz' : 9, 'br' : 11, 'zst' : 19}[name]
+        new_levels[name] = int(level)
+
+    levels.clear()
+    levels.update(new_levels)
+
+# Everything which affects the compressed versions, so that changing it leads
+# to every target being compressed again
+def settings():
+    return [[[codec, level] for codec, level in sorted(levels.items())],
+            min_size, max_ratio]
+
+def compressible(path):
+    mime, encoding = mimetypes.guess_type(path)
+    if encoding is not None:
+        return False
+    if mime is None or mime == 'image/svg+xml':
+        return True
+    if mime in incompressible_types:
+        return False
+    for prefix in incompressible_prefixes:
+        if mime.startswith(prefix):
+            return False
+    return True
+
+def compress(codec, data):
+    level = levels[codec]
+    if codec == 'gz':
+        return gzip.compress(data, compresslevel = level, mtime = 0)
+    elif codec == 'br':
+        return brotli.compress(data, quality = level)
+    else:
+        return zstandard.ZstdCompressor(level = level).compress(data)
+
+def remove_if_present(path):
+    if op.isfile(path):
+        os.remove(path)
+
+# Creates (or removes) the compressed versions of the file at path. data is the
+# contents of the file if they are already in memory, otherwise None. If the
+# file and the settings are unchanged since the last run and all of its
+# compressed versions exist nothing is done. Files which aren't worth
+# compressing are not read at all.
+def compress_target(path, data = None, changed = True):
+    variants = [(codec, path + '.' + codec) for codec in all_codecs]
+
+    size = op.getsize(path) if data is None else len(data)
+    if not (compressible(path) and size >= min_size):
+        for codec, variant in variants:
+            remove_if_present(variant)
+        return
+
+    if not changed:
+        if all(op.isfile(variant) == (codec in levels) for codec, variant in variants):
+            return
+
+    if data is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+
+    for codec, variant in variants:
+        if not (codec in levels):
+            remove_if_present(variant)
+            continue
+
+        compressed = compress(codec, data)
+        if len(compressed) > max_ratio * len(data):
+            remove_if_present(variant)
+        else:
+            with open(variant, 'wb') as f:
+                f.write(compressed)
@@ -6,6 +6,7 @@ import hashlib
 import os.path as op
 
 import document
+import util
 import filelayout
 
 #
@@ -22,6 +23,10 @@ def resolve_name(filename, name):
     else:
         return filename + '/' + name
 
+# If set, no documents are made for the locations which can't be reached from
+# the start, for example the dead branches of a draft
+prune_unreachable = False
+
 class GameTransition:
     def __init__(self, raw_data, filename):
         self.target = resolve_name(filename, raw_data['name'])
@@ -55,20 +60,75 @@ class GameData:
     #           each dictionary has:
     #               name - name of a target location
     #               text - text displayed for that choice
+    #
+    # Every problem with the game (see validate) is reported before a
+    # ValueError is raised, so that they can all be fixed at once.
     def __init__(self, location_files, start_name = 'menu/start'):
         self.name2location = {}
+        self.duplicates = []
         for filename, raw_data in location_files:
             for l in raw_data:
                 location = GameLocation(l, filename)
                 if location.name in self.name2location:
-                    raise ValueError("Duplicate location name " + location.name)
-                self.name2location[location.name] = location
+                    self.duplicates.append(location.name)
+                else:
+                    self.name2location[location.name] = location
+
+        self.start_name = start_name
+        self.start = self.name2location.get(self.start_name)
+        self.reachable = self.find_reachable()
+        self.validate()
 
         self.assign_random_ids()
 
-        assert start_name in self.name2location
-        self.start_name = start_name
-        self.start = self.name2location[self.start_name]
+    # Returns a list of pairs (description, location name) of the problems in
+    # the game: duplicate location names, links to locations which don't exist,
+    # and a missing start, whose location name is None
+    def problems(self):
+        problems = []
+        for name in self.duplicates:
+            problems.append(("Duplicate location name " + name, name))
+        for location in self.name2location.values():
+            for link in location.links:
+                if link.target not in self.name2location:
+                    problems.append(("Link from {} to missing location {}".format(
+                        location.name, link.target), location.name))
+        if self.start is None:
+            problems.append(("Missing start location " + self.start_name, None))
+        return problems
+
+    # With prune_unreachable, the problems in locations which can't be reached
+    # are only warned about, since no documents are made for them
+    def validate(self):
+        errors = 0
+        for problem, name in self.problems():
+            if prune_unreachable and name is not None and not (name in self.reachable):
+                print("**Cyoa (unreachable):", problem)
+            else:
+                print("**Cyoa:", problem)
+                errors += 1
+        if errors > 0:
+            raise ValueError("{} problems in cyoa game".format(errors))
+
+    # Returns the set of names of the locations which can be reached from the
+    # start, following only the links to locations which exist
+    def find_reachable(self):
+        if self.start is None:
+            return set()
+        reachable = set([self.start_name])
+        stack = [self.start]
+        while len(stack) > 0:
+            for link in stack.pop().links:
+                if link.target not in reachable and link.target in self.name2location:
+                    reachable.add(link.target)
+                    stack.append(self.name2location[link.target])
+        return reachable
+
+    # The locations to make documents for, see prune_unreachable
+    def locations(self):
+        if prune_unreachable:
+            return [l for l in self.name2location.values() if l.name in self.reachable]
+        return list(self.name2location.values())
 
     def assign_random_ids(self, generator = hash_hex):
         self.ids = {}
@@ -111,7 +171,7 @@ def parse_semi_json(s):
             else:
                 # This line should be interpreted as json syntax
                 cur_obj = json.loads(line[count:])
-                assert (type(obj) is dict)
+                assert (type(cur_obj) is dict)
             if subobjects not in cur_obj:
                 cur_obj[subobjects] = []
 
@@ -130,19 +190,55 @@ def parse_semi_json(s):
 
     return result
 
-def read_game_data(files):
+#
+# Parsed location files are cached in cyoa_cache_dir under the hash of their
+# contents (as found by scan.py), so only the files which have changed are
+# parsed again. Increase parser_version after changing parse_semi_json.
+#
 
-    locations = []
-    for filename, filepath in files:
-        with open(filepath, 'r') as r:
-            locations.append((filename, parse_semi_json(r.read())))
-    return GameData(locations)
+parser_version = 1
 
-def make_markdown(gd):
-    title = 'Choose your own adventure'
+def location_cache_path(file_hash):
+    return op.join(filelayout.cyoa_cache_dir,
+            '{}-{}.json'.format(file_hash, parser_version))
 
+def read_location_file(filepath, file_hash = None):
+    if file_hash is not None:
+        path = location_cache_path(file_hash)
+        if op.isfile(path):
+            with open(path, 'r') as f:
+                return json.load(f)
+
+    with open(filepath, 'r') as r:
+        result = parse_semi_json(r.read())
+
+    if file_hash is not None:
+        util.write_atomic(path, lambda f : json.dump(result, f, separators = (',', ':')))
+
+    return result
+
+title = 'Choose your own adventure'
+
+# The keys for the choices at a location; there are only keys for the first 35
+def link_keys(loc):
+    keys = []
+    for i, link in enumerate(loc.links):
+        i = i + 1
+        if i < 10:
+            # digits
+            # charcode = str(48 + i)
+            keys.append(str(i))
+        elif i < 36:
+            # letters
+            # charcode = str(97 + i - 10)
+            keys.append(chr(97 + i - 10))
+        else:
+            break
+    return keys
+
+def make_markdown(gd):
     docs = []
-    for loc in gd.name2location.values():
+    for loc in gd.locations():
         haslinks = (len(loc.links) > 0)
 
         markdown = []
@@ -151,19 +247,7 @@ def make_markdown(gd):
             # YAML header block to set various variables
             markdown.append('---')
             markdown.append('link:')
-            for i, link in enumerate(loc.links):
-                i = i + 1
-                if i < 10:
-                    # digits
-                    # charcode = str(48 + i)
-                    key = str(i)
-                elif i < 36:
-                    # letters
-                    # charcode = str(97 + i - 10)
-                    key = chr(97 + i - 10)
-                else:
-                    break
-
+            for key, link in zip(link_keys(loc), loc.links):
                 markdown.append('- key: ' + key)
                 markdown.append('  target: ' + gd.name2location[link.target].unique_name)
                 if '\n' in link.prompt_text:
@@ -203,6 +287,128 @@ def make_markdown(gd):
 
     return docs
 
+#
+# A game can also be compiled into a single page (a "bundle"), holding every
+# location as a <section>, with its choices after it. A script shows one
+# location at a time, following the choices on the page, with the location
+# in the fragment of the URL so that the browser's history works. Choices are
+# followed by clicking on them or by pressing their keys, as on the pages of
+# the locations.
+#
+
+# 'pages' for a page for each location, 'bundle' for a single page, or 'both'
+output = 'pages'
+
+outputs = ['pages', 'bundle', 'both']
+
+# Settings which affect the documents made for a game
+def site_settings():
+    return [output, prune_unreachable]
+
+bundle_style = '''<style>
+.location { display: none; }
+.location.current { display: block; }
+.choice { cursor: pointer; }
+</style>'''
+
+bundle_script = '''<script>
+(function () {
+    var start = START;
+    var current = null;
+
+    function show() {
+        var name = window.location.hash.substring(1);
+        var section = document.getElementById(name);
+        if (section === null || !section.classList.contains('location')) {
+            section = document.getElementById(start);
+        }
+        if (current !== null) {
+            current.classList.remove('current');
+        }
+        current = section;
+        current.classList.add('current');
+        window.scrollTo(0, 0);
+    }
+
+    function follow(choice) {
+        window.location.hash = '#' + choice.getAttribute('data-target');
+    }
+
+    document.addEventListener('click', function (e) {
+        var choice = e.target.closest('.choice');
+        if (choice !== null && !e.target.closest('a')) {
+            follow(choice);
+        }
+    });
+
+    document.addEventListener('keydown', function (e) {
+        if (e.altKey || e.ctrlKey || e.metaKey || current === null) {
+            return;
+        }
+        var focused = document.activeElement;
+        if (e.key === 'Enter' && focused !== null && focused.classList.contains('choice')) {
+            follow(focused);
+            return;
+        }
+        var choices = current.querySelectorAll('.choice');
+        for (var i = 0; i < choices.length; i++) {
+            if (choices[i].getAttribute('data-key') === e.key) {
+                follow(choices[i]);
+                return;
+            }
+        }
+    });
+
+    window.addEventListener('hashchange', show);
+    show();
+})();
+</script>'''
+
+def make_bundle(gd, target_path):
+    markdown = [document.raw_html_block(bundle_style), '']
+
+    for loc in gd.locations():
+        markdown.append(document.raw_html_block(
+            '<section id="{}" class="location">'.format(loc.unique_name)))
+        markdown.append('')
+        markdown.append(loc.text)
+        markdown.append('')
+        for key, link in zip(link_keys(loc), loc.links):
+            target = gd.name2location[link.target].unique_name
+            markdown.append(document.raw_html_block(
+                '<div class="choice" data-key="{}" data-target="{}" tabindex="0" role="link">'.format(
+                    key, target)))
+            markdown.append('')
+            markdown.append(link.prompt_text)
+            markdown.append('')
+            markdown.append(document.raw_html_block('</div>'))
+            markdown.append('')
+        markdown.append(document.raw_html_block('</section>'))
+        markdown.append('')
+
+    markdown.append(document.raw_html_block(
+        bundle_script.replace('START', json.dumps(gd.start.unique_name))))
+
+    d = document.WebDocument()
+    d.name = 'bundle'
+    d.source_data = '\n'.join(markdown)
+    d.set_target_path(target_path)
+    d.is_markdown = True
+    d.template = filelayout.pandoc_cyoa_template
+
+    d.add_variable('pagetitle', title)
+
+    return d
+
+# Returns the documents for the game, as set by output
+def make_documents(gd):
+    if output == 'pages':
+        return make_markdown(gd)
+    elif output == 'bundle':
+        return [make_bundle(gd, filelayout.output_cyoa_index)]
+    else:
+        return make_markdown(gd) + [make_bundle(gd, filelayout.output_cyoa_bundle)]
+
 def make_index(gd):
     html = ['<!DOCTYPE html>',
             '<html>',
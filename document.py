@@ -1,11 +1,82 @@
 import os
 import os.path as op
 import shutil
-import gzip
-import time
+import hashlib
+import json
+import functools
+import traceback
+import concurrent.futures
 
+import util
 import filelayout
 import processmarkdown
+import texify
+import manifest
+import assetstore
+import compress
+
+# Returns (name, is_markdown, target_path) for the document made from the
+# source file at path, which need not exist any more
+def source_target(path, root = None):
+    if root is None:
+        root = filelayout.main_dir
+
+    name = op.basename(path)
+    assert len(name) > 0
+
+    is_markdown = False
+    nomove = False
+
+    if name.endswith('.md'):
+        is_markdown = True
+        nomove = True
+
+        name = name[:-3]
+    elif name.endswith('.nomove'):
+        nomove = True
+
+        name = name[:-7]
+
+    assert len(name) > 0
+
+    if nomove:
+        target_path = op.join(filelayout.output_dir,
+                op.relpath(op.dirname(path), root), name)
+    else:
+        target_path = op.join(filelayout.output_resources_dir, name)
+
+    return name, is_markdown, target_path
+
+# Whether the file at path exists and has the given size and the same hash as
+# the data fed to a hash object by update
+def same_contents(path, size, update):
+    if not (op.isfile(path) and op.getsize(path) == size):
+        return False
+
+    h_old = hashlib.sha256()
+    util.hash_file(h_old, path)
+    h_new = hashlib.sha256()
+    update(h_new)
+    return h_old.digest() == h_new.digest()
+
+# Templates are shared by many documents, so their hashes are remembered
+@functools.lru_cache(maxsize = None)
+def template_hash(path):
+    return util.sha256_file(path)
+
+# Returns a fenced block of raw html for pandoc markdown, with a fence longer
+# than any run of backticks in the html
+def raw_html_block(html):
+    longest = 0
+    run = 0
+    for c in html:
+        if c == '`':
+            run += 1
+            longest = max(longest, run)
+        else:
+            run = 0
+    fence = '`' * max(3, longest + 1)
+    return '{}{{=html}}\n{}\n{}'.format(fence, html.rstrip('\n'), fence)
 
 def is_parent_path(parent, child):
     parent = op.realpath(parent)
@@ -19,8 +90,23 @@ class WebDocument:
     # target_path       absolute (in output dir)
     #
     # source_data       in memory copy of the source data
+    # source_hash       sha256 of the source file, if known
     # target_data       in memory copy of the target data
     #
+    # ast               pandoc json of a markdown document which has been parsed
+    #                   but not yet written out
+    # equations         list of texify.LatexEquation found in ast
+    # assets            names of the files in the auto-generated resource store
+    #                   used by the target (see assetstore.py)
+    #
+    # make_fragment     if set, the html of the body of this markdown document is
+    #                   also kept on its own, see fragment_path
+    # parts             if not None, the markdown source is made up of these, in
+    #                   order: each a string of markdown, or a document with
+    #                   make_fragment set whose html is included as it is. The
+    #                   fragments are only read once they have been made, see
+    #                   assemble.
+    #
     def __init__(self):
         self.name = None
 
@@ -30,50 +116,42 @@ class WebDocument:
         self.source_data = None
         self.target_data = None
 
+        self.source_hash = None
+
+        self.ast = None
+        self.equations = None
+        self.assets = set()
+
+        self.make_fragment = False
+        self.parts = None
+
         self.is_markdown = False
 
         self.template = filelayout.pandoc_html_template
         self.meta_variables = []
 
-        self.modtime = None
+        # 'png', 'svg' or 'both', or None for processmarkdown.math_output
+        self.math_output = None
 
     # static
     #
     # path is either absolute path to the source file, or relative to the working directory
     # If there is an extension .md or .nomove, acts appropriately
-    def from_source_path(path, root = None):
-        if root is None:
-            root = filelayout.main_dir
-
-        assert op.isfile(path)
+    #
+    # If the file has been seen by scan.py, info is its entry there, which saves
+    # looking at the file again.
+    def from_source_path(path, root = None, info = None):
+        if info is None:
+            assert op.isfile(path)
 
         self = WebDocument()
-        self.name = op.basename(path)
         self.source_path = path
-        self.modtime = op.getmtime(path)
-        assert len(self.name) > 0
-
-        nomove = False
-
-        if self.name.endswith('.md'):
-            self.is_markdown = True
-            nomove = True
-
-            self.name = self.name[:-3]
-        elif self.name.endswith('.nomove'):
-            nomove = True
-
-            self.name = self.name[:-7]
-
-        assert len(self.name) > 0
-
-        if nomove:
-            target_path = op.join(filelayout.output_dir,
-                    op.relpath(op.dirname(path), root), self.name)
-        else:
-            target_path = op.join(filelayout.output_resources_dir, self.name)
+        self.name, self.is_markdown, target_path = source_target(path, root)
         self.set_target_path(target_path)
 
+        if info is not None:
+            self.source_hash = info['hash']
+
         return self
 
     def set_target_path(self, target_path):
@@ -97,38 +175,116 @@ class WebDocument:
                 args.append('{}={}'.format(key, value))
         return args
 
+    def update_source_hash(self, h):
+        if self.source_data is not None:
+            h.update(self.source_data.encode('utf8'))
+        else:
+            if self.source_hash is None:
+                self.source_hash = util.sha256_file(self.source_path)
+            h.update(self.source_hash.encode('utf8'))
+
+    # Hash of everything which affects the contents of the target: the source
+    # (or the in-memory target, if there is one, or the parts), and for
+    # markdown the template and the variables passed to it, which include the
+    # blog newer/older links, and the settings of processmarkdown. The
+    # compression settings are included too, so that the compressed versions
+    # are made again when they change (see process_all).
+    def fingerprint(self):
+        h = hashlib.sha256()
+        h.update(json.dumps([self.is_markdown, self.source_data is None,
+            self.target_data is None, self.parts is None,
+            compress.settings()]).encode('utf8'))
+
+        if self.target_data is not None:
+            h.update(self.target_data.encode('utf8'))
+        elif self.parts is not None:
+            for part in self.parts:
+                if isinstance(part, str):
+                    h.update(json.dumps(['markdown', part]).encode('utf8'))
+                else:
+                    h.update(json.dumps(['html', part.fragment_fingerprint()]).encode('utf8'))
+        else:
+            self.update_source_hash(h)
+
+        if self.is_markdown:
+            h.update(template_hash(self.template).encode('utf8'))
+            h.update(json.dumps(self.meta_variables).encode('utf8'))
+            h.update(json.dumps(processmarkdown.output_settings(self)).encode('utf8'))
+
+        return h.hexdigest()
+
+    # Hash of everything which affects the html of the body alone, which unlike
+    # the target does not depend on the template or the variables
+    def fragment_fingerprint(self):
+        h = hashlib.sha256()
+        h.update(json.dumps([manifest.build_version, self.relroot,
+            processmarkdown.output_settings(self)]).encode('utf8'))
+        self.update_source_hash(h)
+        return h.hexdigest()
+
+    def fragment_path(self):
+        return op.join(filelayout.fragment_cache_dir,
+                self.fragment_fingerprint() + '.html')
+
+    # Whether the fragment, if one is wanted, has been made
+    def has_fragment(self):
+        return (not self.make_fragment) or op.isfile(self.fragment_path())
+
+    def part_documents(self):
+        return [part for part in self.parts if not isinstance(part, str)]
+
+    # Makes the markdown source from the parts, once the fragments exist.
+    # Fragments are included with their links unchanged, so they must have
+    # been made for the same relroot.
+    def assemble(self):
+        source = []
+        for part in self.parts:
+            if isinstance(part, str):
+                source.append(part)
+            else:
+                assert part.relroot == self.relroot
+                with open(part.fragment_path(), 'r') as f:
+                    source.append(raw_html_block(f.read()))
+        self.source_data = '\n\n'.join(source)
+
+        # The documents of the parts are not needed any more, and should not be
+        # sent to worker processes
+        self.parts = None
+
+    # Returns True if the target was written, or False if it already had the
+    # right contents. Unchanged files are left alone so that their mtimes do not
+    # change. Compressed versions are made separately, see compress.py.
     def save_target(self):
         os.makedirs(op.dirname(self.target_path), exist_ok = True)
+
         if self.target_data is None:
-            shutil.copyfile(self.source_path, self.target_path)
+            size = op.getsize(self.source_path)
+            changed = not same_contents(self.target_path, size,
+                    lambda h : util.hash_file(h, self.source_path))
+            if changed:
+                shutil.copyfile(self.source_path, self.target_path)
         else:
-            with open(self.target_path, 'w') as f:
-                f.write(self.target_data)
-
-        size = op.getsize(self.target_path)
-        target_gz = self.target_path + '.gz'
+            data = self.target_data.encode('utf8')
+            changed = not same_contents(self.target_path, len(data),
+                    lambda h : h.update(data))
+            if changed:
+                with open(self.target_path, 'wb') as f:
+                    f.write(data)
 
-        if size >= 500:
-            with open(self.target_path, 'rb') as f_in:
-                with gzip.GzipFile(target_gz, 'wb', mtime = 0) as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            # with open(self.target_path, 'rb') as f_in:
-                # with gzip.open(target_gz, 'wb') as f_out:
-
-        else:
-            if op.isfile(target_gz):
-                os.remove(target_gz)
+        return changed
 
     def process_markdown(self):
         processmarkdown.process_markdown(self)
 
-    def process(self):
-        print("Processing {} -> {}".format(self.name,
-            op.relpath(self.target_path, filelayout.output_dir)))
+    def describe(self):
+        return "{} -> {}".format(self.name,
+            op.relpath(self.target_path, filelayout.output_dir))
 
+    # Returns whether the target changed
+    def process(self):
         if self.is_markdown:
             self.process_markdown()
-        self.save_target()
+        return self.save_target()
 
 def check_target_conflicts(documents):
     duplicates = False
@@ -145,11 +301,239 @@ def check_target_conflicts(documents):
     if duplicates:
         raise Exception("Duplicate targets")
 
-def process_all(documents, only_recent = False):
-    check_target_conflicts(documents)
+#
+# Documents can be processed by a pool of worker processes. Each stage maps a
+# top-level function over a list of items; the results come back in the order
+# of the items, so output is the same regardless of the number of workers.
+# Documents are pickled to and from the workers, so their state is copied back
+# into the originals once a stage is done with them.
+#
+
+def init_worker(settings):
+    texify.use_private_workdir()
+    processmarkdown.apply_worker_settings(settings)
+
+# Returns (result, error), where error is the formatted traceback if function
+# raised an exception.
+def guarded(function, item):
+    try:
+        return function(item), None
+    except Exception:
+        return None, traceback.format_exc()
+
+# Returns a list of (item, result, error)
+def run_jobs(pool, function, items):
+    call = functools.partial(guarded, function)
+    if pool is None:
+        results = map(call, items)
+    else:
+        results = pool.map(call, items)
+
+    return [(item, result, error) for item, (result, error) in zip(items, results)]
+
+# Like run_jobs, but each item is a batch of documents (see
+# processmarkdown.make_batches) and function returns a list of (result, error)
+# for the documents of a batch. Returns a list of (document, result, error).
+def run_batches(pool, function, batches):
+    results = []
+    for batch, result, error in run_jobs(pool, function, batches):
+        if error is None:
+            results.extend((d, r, e) for d, (r, e) in zip(batch, result))
+        else:
+            results.extend((d, None, error) for d in batch)
+    return results
+
+# Returns the document and whether its pandoc json was cached
+def parse_document(d):
+    hit = processmarkdown.parse_markdown(d)
+    return d, hit
+
+def parse_documents(docs):
+    batched = set()
+    if len(docs) > 1:
+        batched = set(id(d) for d in processmarkdown.parse_markdown_batch(docs))
+
+    results = []
+    for d in docs:
+        result, error = guarded(parse_document, d)
+        if error is None and id(d) in batched:
+            result = (d, False)
+        results.append((result, error))
+    return results
+
+# Returns the document and whether its target changed
+def process_document(d):
+    changed = d.process()
+    return d, changed
+
+def save_document(item):
+    d, text = item
+    if d.target_data is None:
+        processmarkdown.convert_html(d, text)
+    return d, d.save_target()
+
+def process_documents(docs):
+    if len(docs) == 1:
+        return [guarded(process_document, docs[0])]
+
+    results = [None] * len(docs)
+    items = []
+    for i, d in enumerate(docs):
+        text, error = guarded(processmarkdown.transform_markdown, d)
+        if error is None:
+            items.append((i, d, text))
+        else:
+            results[i] = (None, error)
+
+    processmarkdown.convert_html_batch([(d, text) for i, d, text in items])
+    for i, d, text in items:
+        results[i] = guarded(save_document, (d, text))
+    return results
+
+def compress_target(task):
+    d, changed = task
+    data = None
+    if d.target_data is not None:
+        data = d.target_data.encode('utf8')
+    compress.compress_target(d.target_path, data, changed)
+
+def report_failure(description, error):
+    print("**Failed:", description)
+    print(error)
+
+# Parses, renders the equations of and processes the documents, adding those
+# which fail to failed. Returns a list of (document, whether its target changed)
+# for the others.
+def process_round(pool, jobs, documents, m, references, fingerprints, failed):
+    # All markdown is parsed up front so that the equations of every
+    # document can be typeset together, with one run of latex per worker.
+    markdown = []
+    hits = 0
+    for d, result, error in run_batches(pool, parse_documents,
+            processmarkdown.make_batches([d for d in documents if d.is_markdown], jobs)):
+        if error is None:
+            parsed, hit = result
+            d.__dict__.update(parsed.__dict__)
+            markdown.append(d)
+            hits += hit
+        else:
+            report_failure("parsing " + d.describe(), error)
+            failed.append(d)
+    print("Parsed {} markdown documents, {} found in the cache".format(
+        len(markdown), hits))
+
+    equations = processmarkdown.share_equations(markdown)
+    chunks = [equations[i::max(jobs, 1)] for i in range(max(jobs, 1))]
+    for chunk, result, error in run_jobs(pool,
+            processmarkdown.make_equation_images, chunks):
+        if error is None:
+            for equation, rendered in zip(chunk, result):
+                equation.__dict__.update(rendered.__dict__)
+        else:
+            report_failure("rendering {} equations".format(len(chunk)), error)
+            for equation in chunk:
+                equation.error = "Rendering failed"
+                equation.broken = True
+
+    # Documents with equations which could not be rendered are still written,
+    # but count as failed, and are removed from the manifest so that they are
+    # built again next time
+    broken = set(id(d) for d in markdown
+            if any(equation.broken for equation in d.equations))
+
+    saved = []
+    for d, result, error in run_batches(pool, process_documents,
+            processmarkdown.make_batches([d for d in documents if d not in failed], jobs)):
+        if error is None:
+            processed, changed = result
+            d.__dict__.update(processed.__dict__)
+            saved.append((d, changed))
+            references.record(d)
+            if id(d) in broken:
+                print("**Failed to render the equations of", d.describe())
+                failed.append(d)
+                m.forget(d)
+            else:
+                m.record(d, fingerprints[d.target_path])
+                print("Processed", d.describe())
+        else:
+            report_failure(d.describe(), error)
+            failed.append(d)
 
-    recent = time.time() - 7 * 24 * 60 * 60
+    return saved
+
+# If only_changed is set, documents whose inputs are the same as when their
+# target was last built (according to the manifest) are skipped.
+#
+# Documents made up of parts are done after all of the others, once the
+# fragments they include have been made.
+def process_all(documents, only_changed = False, jobs = 1):
+    check_target_conflicts(documents)
 
+    m = manifest.Manifest()
+    references = assetstore.References()
+    fingerprints = {}
+    # The targets whose fingerprint differs from the one they were built with.
+    # Their compressed versions are made again even if the target itself is
+    # unchanged, since the fingerprint includes the compression settings.
+    stale = set()
+    todo = []
     for d in documents:
-        if (not only_recent) or (d.modtime > recent):
-            d.process()
+        fingerprint = d.fingerprint()
+        fingerprints[d.target_path] = fingerprint
+        current = m.is_current(d, fingerprint)
+        if not current:
+            stale.add(d.target_path)
+        if not (only_changed and current and d.has_fragment()):
+            todo.append(d)
+
+    print("{} of {} documents to process".format(len(todo), len(documents)))
+
+    if jobs > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(jobs, initializer = init_worker,
+                initargs = (processmarkdown.worker_settings(),))
+    else:
+        pool = None
+
+    failed = []
+    try:
+        saved = process_round(pool, jobs, [d for d in todo if d.parts is None],
+                m, references, fingerprints, failed)
+
+        assembled = []
+        for d in todo:
+            if d.parts is None:
+                continue
+            if any(part in failed for part in d.part_documents()):
+                print("**Skipped, as a part of it failed:", d.describe())
+                failed.append(d)
+                continue
+            try:
+                d.assemble()
+                assembled.append(d)
+            except Exception:
+                report_failure("assembling " + d.describe(), traceback.format_exc())
+                failed.append(d)
+
+        if len(assembled) > 0:
+            saved += process_round(pool, jobs, assembled,
+                    m, references, fingerprints, failed)
+
+        # The compression libraries release the GIL, so threads are enough here,
+        # and the documents in memory do not need to be sent anywhere.
+        with concurrent.futures.ThreadPoolExecutor(jobs) as threads:
+            tasks = [(d, changed or d.target_path in stale) for d, changed in saved]
+            for (d, changed), result, error in run_jobs(threads, compress_target, tasks):
+                if error is not None:
+                    report_failure("compressing " + d.describe(), error)
+                    failed.append(d)
+                    m.forget(d)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+            texify.remove_private_workdirs()
+        m.save()
+        references.save()
+
+    if len(failed) > 0:
+        raise Exception("{} documents failed".format(len(failed)))
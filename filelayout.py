@@ -7,12 +7,20 @@ input_dir = op.join(root_dir, 'input')
 output_dir = op.join(root_dir, 'www')
 working_dir = op.join(root_dir, 'working')
 latex_dir = op.join(working_dir, 'latex')
+latex_format_dir = op.join(working_dir, 'latexformat')
+equation_cache_dir = op.join(working_dir, 'equations')
+ast_cache_dir = op.join(working_dir, 'ast')
+fragment_cache_dir = op.join(working_dir, 'fragments')
+cyoa_cache_dir = op.join(working_dir, 'cyoa')
+manifest_path = op.join(working_dir, 'manifest.json')
+asset_references_path = op.join(working_dir, 'assets.json')
 
 pandoc_html_template = op.join(input_dir, 'template.html')
 pandoc_cyoa_template = op.join(input_dir, 'template_cyoa.html')
 pandoc_blog_template = op.join(input_dir, 'template_blog.html')
 pandoc_blog_compact_template = op.join(input_dir, 'template_blog_index_compact.html')
 pandoc_blog_expanded_template = op.join(input_dir, 'template_blog_index_expanded.html')
+link_names_path = op.join(input_dir, 'linknames.txt')
 main_dir = op.join(input_dir, 'main')
 cyoa_dir = op.join(input_dir, 'cyoa')
 
@@ -20,6 +28,7 @@ output_auto_generated_dir = op.join(output_dir, 'a')
 output_resources_dir = op.join(output_dir, 'r')
 output_cyoa_dir = op.join(output_dir, 'cyoa')
 output_cyoa_index = op.join(output_cyoa_dir, 'index.html')
+output_cyoa_bundle = op.join(output_cyoa_dir, 'bundle.html')
 output_blog_dir = op.join(output_dir, 'posts')
 output_blog_index_compact = op.join(output_blog_dir, 'index.html')
 
@@ -29,8 +38,18 @@ def cyoa_target_path(name):
 def blog_target_path(name):
     return op.join(output_blog_dir, name)
 
-def blog_index_expanded_path(year):
-    return op.join(output_blog_dir, 'index_{}'.format(year))
+# Page numbers count from 0; the first page of a year is just index_<year>
+def blog_index_expanded_name(year, page = 0):
+    if page == 0:
+        return 'index_{}'.format(year)
+    else:
+        return 'index_{}_{}'.format(year, page + 1)
+
+def blog_index_expanded_path(year, page = 0):
+    return op.join(output_blog_dir, blog_index_expanded_name(year, page))
+
+def blog_tag_index_path(tag):
+    return op.join(output_blog_dir, 'tag_{}'.format(tag))
 
 def path_to_auto_resource(name):
     return op.join(output_auto_generated_dir, name)
@@ -0,0 +1,49 @@
+import os.path as op
+import json
+
+import util
+import filelayout
+
+#
+# The manifest records, for each target file, the fingerprint (see
+# WebDocument.fingerprint) of the inputs it was last built from. A document
+# only needs to be processed again if its fingerprint has changed or its
+# target is missing.
+#
+# Increase this to force everything to be rebuilt after a change to the way
+# documents are processed.
+#
+build_version = 2
+
+class Manifest:
+    def __init__(self, path = None):
+        if path is None:
+            path = filelayout.manifest_path
+        self.path = path
+        self.fingerprints = {}
+
+        if op.isfile(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == build_version:
+                self.fingerprints = data['targets']
+
+    def key(self, d):
+        return op.relpath(d.target_path, filelayout.output_dir)
+
+    def is_current(self, d, fingerprint):
+        return (op.isfile(d.target_path) and
+                self.fingerprints.get(self.key(d)) == fingerprint)
+
+    def record(self, d, fingerprint):
+        self.fingerprints[self.key(d)] = fingerprint
+
+    # For documents which failed after their target was written, so that the
+    # target isn't taken to be current
+    def forget(self, d):
+        self.fingerprints.pop(self.key(d), None)
+
+    def save(self):
+        data = {'version' : build_version, 'targets' : self.fingerprints}
+        util.write_atomic(self.path, lambda f : json.dump(data, f,
+            indent = 0, sort_keys = True))
@@ -0,0 +1,109 @@
+--
+-- Runs a batch of conversions in a single pandoc process, for processmarkdown.py:
+--   pandoc lua pandocbatch.lua MODE SEPARATOR
+-- The input and the output are records, each followed by a line holding just
+-- the separator, and there is one output record for each input record. MODE is
+--   json   -- each record is markdown, which is converted to pandoc json, as
+--             by "pandoc -f markdown -t json"
+--   html   -- each record is a line with the path of a template, or an empty
+--             line for none, a line with the number of variables, that many
+--             lines "key=value" or "key", and then pandoc json, which is
+--             converted to html as by "pandoc -s -f json -t html --template
+--             ... -V ...", or without -s if there is no template
+-- Each document is read and written on its own, so metadata, identifiers and
+-- footnotes are exactly as if it had been converted by itself.
+--
+
+local mode, separator = arg[1], arg[2]
+local marker = '\n' .. separator .. '\n'
+
+local function records(text)
+  local result = {}
+  local start = 1
+  while true do
+    local i, j = text:find(marker, start, true)
+    if i == nil then
+      break
+    end
+    table.insert(result, text:sub(start, i - 1))
+    start = j + 1
+  end
+  return result
+end
+
+local templates = {}
+
+local function template(path)
+  if templates[path] == nil then
+    local f = assert(io.open(path, 'r'))
+    local text = f:read('a')
+    f:close()
+    templates[path] = pandoc.template.compile(text, path)
+  end
+  return templates[path]
+end
+
+-- Same as the -V arguments: no value means true, and a repeated key a list
+local function add_variable(variables, line)
+  local key, value
+  local equals = line:find('=', 1, true)
+  if equals == nil then
+    key, value = line, true
+  else
+    key, value = line:sub(1, equals - 1), line:sub(equals + 1)
+  end
+
+  if variables[key] == nil then
+    variables[key] = value
+  elseif type(variables[key]) == 'table' then
+    table.insert(variables[key], value)
+  else
+    variables[key] = {variables[key], value}
+  end
+end
+
+local function to_html(record)
+  local pos = 1
+  local function next_line()
+    local e = record:find('\n', pos, true)
+    local line = record:sub(pos, e - 1)
+    pos = e + 1
+    return line
+  end
+
+  local path = next_line()
+  local count = tonumber(next_line())
+  local variables = {}
+  for i = 1, count do
+    add_variable(variables, next_line())
+  end
+
+  local doc = pandoc.read(record:sub(pos), 'json')
+  local options = {}
+  if path ~= '' then
+    options.template = template(path)
+    options.variables = variables
+  end
+  return pandoc.write(doc, 'html', options)
+end
+
+local function to_json(record)
+  return pandoc.write(pandoc.read(record, 'markdown'), 'json')
+end
+
+local convert
+if mode == 'json' then
+  convert = to_json
+elseif mode == 'html' then
+  convert = to_html
+else
+  error('Unknown mode ' .. tostring(mode))
+end
+
+for _, record in ipairs(records(io.read('a'))) do
+  local output = convert(record)
+  if output:sub(-1) ~= '\n' then
+    output = output .. '\n'
+  end
+  io.write(output, separator, '\n')
+end
@@ -27,7 +27,9 @@
 #   (one or more) choose-your-own-adventure games. The body of these locations
 #   are treated as markdown and the processed files are put in /cyoa/
 #
-#   (TODO: option to compile a cyoa game as a standalone html directory.)
+#   With --cyoa=bundle the game is instead compiled into a single page,
+#   /cyoa/index.html, which moves between locations without loading anything
+#   else; --cyoa=both makes the pages and /cyoa/bundle.html.
 #   
 #   Any images generated for Latex figures from markdown files are saved
 #   in /a/<xxxx>.png (or svg can be used) where <xxxx> is the
@@ -44,55 +46,88 @@
 import sys
 import os
 import os.path
+import traceback
 
 import document
 import filelayout
+import processmarkdown
+import compress
+import assetstore
+import manifest
+import scan
+import watch
 import blog
 import cyoa
+import autolink
 
 def valid_input_file(filename):
     if filename.endswith('.swp') or filename.endswith('.hide'):
         return False
     return True
 
-# Walks over all input files: paths to blog files are fed into
-# process_blog, and other paths into process_other.
-def walk_input(process_blog, process_other):
-    for dirpath, dirnames, filenames in os.walk(filelayout.main_dir):
-        for filename in filenames:
-            if not valid_input_file(filename):
-                continue
-
-            path = os.path.join(dirpath, filename)
-            if filename.endswith('.blog'):
-                process_blog(path)
-            else:
-                process_other(path)
+# Scans the input directories for files which are new or have changed since
+# the last build (see scan.py). Returns a dictionary of scan.Changes.
+def scan_input(snapshots = None):
+    if snapshots is None:
+        snapshots = input_snapshots()
 
-def create_cyoa_documents():
-    modtime = 0
+    settings = ([manifest.build_version] + processmarkdown.site_settings() +
+            blog.site_settings() + cyoa.site_settings() + compress.settings())
+    return {
+            'main' : snapshots['main'].scan(
+                filelayout.main_dir, valid_input_file, settings),
+            'cyoa' : snapshots['cyoa'].scan(
+                filelayout.cyoa_dir, valid_input_file, settings),
+            'templates' : snapshots['templates'].scan(
+                filelayout.input_dir, valid_input_file, settings, recursive = False)
+        }
 
-    files = []
-    for dirpath, dirnames, filenames in os.walk(filelayout.cyoa_dir):
-        for filename in filenames:
-            if valid_input_file(filename):
-                filepath = os.path.join(dirpath, filename)
-                filename = os.path.relpath(filepath, filelayout.cyoa_dir)
-                files.append((filename, filepath))
-                modtime = max(modtime, os.path.getmtime(filepath))
+def input_snapshots():
+    return {
+            'main' : scan.Snapshot('main'),
+            'cyoa' : scan.Snapshot('cyoa'),
+            'templates' : scan.Snapshot('templates')
+        }
 
-    gd = cyoa.read_game_data(files)
-
-    docs = cyoa.make_markdown(gd)
+# Walks over all input files: paths to blog files are fed into
+# process_blog, and other paths into process_other.
+def walk_input(main, process_blog, process_other):
+    for path in sorted(main.files):
+        if path.endswith('.blog'):
+            process_blog(path)
+        else:
+            process_other(path)
 
-    for d in docs:
-        d.modtime = modtime
+# Every location is made into a document, but as the document of a location is
+# only made from its markdown, which only depends on the location and the names
+# of its targets, the manifest picks out the locations which have changed.
+def create_cyoa_documents(changes):
+    location_files = []
+    for filepath in sorted(changes.files):
+        filename = os.path.relpath(filepath, filelayout.cyoa_dir)
+        location_files.append((filename, cyoa.read_location_file(filepath,
+            changes.files[filepath]['hash'])))
 
-    return docs
+    return cyoa.make_documents(cyoa.GameData(location_files))
 
-def create_documents(create_blog = True, create_cyoa = True, create_other = True):
+# If only_changed is set, documents are only made from input files which have
+# changed since the last build, where a change to a template counts as a change
+# to every file. The blog and cyoa documents depend on all of their input
+# files, so they are all made if any of those changed.
+def create_documents(create_blog = True, create_cyoa = True, create_other = True,
+        inputs = None, only_changed = False):
     ignore = lambda x : 0
 
+    if inputs is None:
+        inputs = scan_input()
+    main = inputs['main']
+
+    everything = (not only_changed) or inputs['templates'].any()
+    if not everything:
+        main_changed = main.added | main.changed | main.removed
+        create_blog = create_blog and any(path.endswith('.blog') for path in main_changed)
+        create_cyoa = create_cyoa and inputs['cyoa'].any()
+
     if create_blog:
         b = blog.Blog()
         def process_blog(path):
@@ -107,11 +142,13 @@ def create_documents(create_blog = True, create_cyoa = True, create_other = True
     if create_other:
         docs_other = []
         def process_other(path):
-            docs_other.append(document.WebDocument.from_source_path(path))
+            if everything or main.is_modified(path):
+                docs_other.append(document.WebDocument.from_source_path(path,
+                    info = main.files[path]))
     else:
         process_other = ignore
 
-    walk_input(process_blog, process_other)
+    walk_input(main, process_blog, process_other)
 
     docs_all = []
     if create_other:
@@ -119,14 +156,146 @@ def create_documents(create_blog = True, create_cyoa = True, create_other = True
     if create_blog:
         docs_all.extend(b.create_documents())
     if create_cyoa:
-        docs_all.extend(create_cyoa_documents())
+        docs_all.extend(create_cyoa_documents(inputs['cyoa']))
 
     return docs_all
 
+# Deletes the targets (and their compressed versions) of input files which
+# have been removed, unless another input file now has the same target
+def remove_old_targets(main):
+    current = set()
+    for path in main.files:
+        if not path.endswith('.blog'):
+            current.add(document.source_target(path)[2])
+
+    for path in sorted(main.removed):
+        if path.endswith('.blog'):
+            continue
+        target = document.source_target(path)[2]
+        if target in current:
+            continue
+        for p in [target] + [target + '.' + codec for codec in compress.all_codecs]:
+            if os.path.isfile(p):
+                print("Removing", os.path.relpath(p, filelayout.output_dir))
+                os.remove(p)
+
+#
+# Watch mode: the input directory is watched for changes, and after each change
+# the affected documents are rebuilt. The parsed blog and cyoa files are kept in
+# memory, and only the files which changed are read again. All documents are
+# then made again from the parsed files, which is cheap, and the manifest picks
+# out those whose inputs changed: for example a post which was edited, the year
+# index containing it and the compact index, or the cyoa locations which were
+# touched.
+#
+
+class Watcher:
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.snapshots = input_snapshots()
+
+        self.blog_posts = {}        # path of .blog file -> list of blog.BlogPost
+        self.cyoa_locations = {}    # path of cyoa file -> parsed contents
+
+        # Set once update has read every input file. Until then every build
+        # reads them all, as if it were the first.
+        self.loaded = False
+
+    # Reads the files which changed (or every file, if initial is set) and
+    # returns the documents. The documents themselves are made afresh every
+    # time, as processing leaves its results in them.
+    def update(self, inputs, initial):
+        main = inputs['main']
+        templates_changed = inputs['templates'].any()
+        if templates_changed:
+            document.template_hash.cache_clear()
+            # Social posts are linked as they are read, see autolink.py
+            autolink.reset()
+
+        if initial or templates_changed:
+            modified = set(main.files)
+        else:
+            modified = main.added | main.changed
+
+        for path in main.removed:
+            self.blog_posts.pop(path, None)
+        for path in sorted(modified):
+            if path.endswith('.blog'):
+                self.blog_posts[path] = blog.read_posts(path)
+
+        docs = []
+        for path in sorted(main.files):
+            if not path.endswith('.blog'):
+                docs.append(document.WebDocument.from_source_path(path,
+                        info = main.files[path]))
+
+        b = blog.Blog()
+        for path in sorted(self.blog_posts):
+            b.posts.extend(self.blog_posts[path])
+        docs += b.create_documents()
+
+        cyoa_changes = inputs['cyoa']
+        if initial:
+            modified = set(cyoa_changes.files)
+        else:
+            modified = cyoa_changes.added | cyoa_changes.changed
+
+        for path in cyoa_changes.removed:
+            self.cyoa_locations.pop(path, None)
+        for path in modified:
+            self.cyoa_locations[path] = cyoa.read_location_file(path,
+                    cyoa_changes.files[path]['hash'])
+
+        files = [(os.path.relpath(path, filelayout.cyoa_dir), self.cyoa_locations[path])
+                for path in sorted(self.cyoa_locations)]
+        docs += cyoa.make_documents(cyoa.GameData(files))
+
+        return docs
+
+    def build(self, initial = False):
+        initial = initial or not self.loaded
+        inputs = scan_input(self.snapshots)
+        if not (initial or any(changes.any() for changes in inputs.values())):
+            return
+
+        # If the input files can't be read, the snapshots are left as they
+        # are, so that the same changes are read again next time
+        try:
+            docs = self.update(inputs, initial)
+        except Exception:
+            traceback.print_exc()
+            return
+        self.loaded = True
+
+        try:
+            document.process_all(docs, only_changed = True, jobs = self.jobs)
+        except Exception:
+            traceback.print_exc()
+
+        remove_old_targets(inputs['main'])
+
+        # Failed documents are not recorded in the manifest, so they are tried
+        # again after the next change
+        for changes in inputs.values():
+            changes.save()
+
+    def run(self):
+        notifier = watch.make_notifier(filelayout.input_dir)
+        self.build(initial = True)
+        print("Watching for changes")
+        while True:
+            watch.wait_for_changes(notifier)
+            self.build()
+
 def create_directories():
     paths = [
             filelayout.working_dir,
             filelayout.latex_dir,
+            filelayout.latex_format_dir,
+            filelayout.equation_cache_dir,
+            filelayout.ast_cache_dir,
+            filelayout.fragment_cache_dir,
+            filelayout.cyoa_cache_dir,
             filelayout.output_dir,
             filelayout.output_auto_generated_dir,
             filelayout.output_resources_dir]
@@ -137,33 +306,128 @@ def create_directories():
 def run():
     args = sys.argv[1:]
 
-    if len(args) == 0:
+    create_blog = False
+    create_cyoa = False
+    create_other = False
+    changed = False
+    jobs = 1
+    pandoc_server = False
+    gc = False
+    watching = False
+
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if arg == 'blog':
+            create_blog = True
+        elif arg == 'cyoa':
+            create_cyoa = True
+        elif arg == 'other':
+            create_other = True
+        elif arg == 'changed' or arg == 'recent':
+            # Only rebuild targets whose inputs have changed since the last build
+            changed = True
+        elif arg == 'watch':
+            # Rebuild whenever the input changes
+            watching = True
+        elif arg == 'gc':
+            # Delete auto-generated resources which are no longer used
+            gc = True
+        elif arg.startswith('--compress='):
+            # For example --compress=gz:9,br:11,zst:19
+            compress.configure(arg[len('--compress='):])
+        elif arg.startswith('--math='):
+            # png, svg or both
+            output = arg[len('--math='):]
+            if output not in processmarkdown.math_output_formats:
+                raise ValueError("Unknown math output \"{}\".".format(output))
+            processmarkdown.math_output = output
+        elif arg.startswith('--cyoa='):
+            # pages, bundle or both
+            output = arg[len('--cyoa='):]
+            if output not in cyoa.outputs:
+                raise ValueError("Unknown cyoa output \"{}\".".format(output))
+            cyoa.output = output
+        elif arg == '--cyoa-prune':
+            # Leave out cyoa locations which can't be reached
+            cyoa.prune_unreachable = True
+        elif arg == '--math-sprites':
+            # Draw the equations of each page from a single sprite image
+            processmarkdown.math_layout = 'sprite'
+        elif arg.startswith('--index-posts='):
+            # Most posts on a page of the expanded blog index
+            blog.index_page_posts = int(arg[len('--index-posts='):])
+        elif arg.startswith('--index-bytes='):
+            # Most bytes of post markdown on a page of the expanded blog index
+            blog.index_page_bytes = int(arg[len('--index-bytes='):])
+        elif arg == '--pandoc-server':
+            pandoc_server = True
+        elif arg == '--pandoc-batch':
+            # Convert small documents in batches, see processmarkdown.py
+            processmarkdown.batch_documents = True
+        elif arg.startswith('-j'):
+            # Either "-j N" or "-jN"
+            if arg == '-j':
+                if i == len(args):
+                    raise ValueError("Expected a number of jobs after -j.")
+                arg = args[i]
+                i += 1
+            else:
+                arg = arg[2:]
+            jobs = int(arg)
+            if jobs < 1:
+                raise ValueError("Number of jobs must be positive.")
+        else:
+            raise ValueError(
+                    "Don't understand command line argument \"{}\".".format(arg))
+
+    # Build everything unless specific targets were asked for
+    if not (create_blog or create_cyoa or create_other or gc):
         create_blog = True
         create_cyoa = True
         create_other = True
-        recent = False
-    else:
-        create_blog = False
-        create_cyoa = False
-        create_other = False
-        recent = False
-        for arg in args:
-            if arg == 'blog':
-                create_blog = True
-            elif arg == 'cyoa':
-                create_cyoa = True
-            elif arg == 'other':
-                create_other = True
-            elif arg == 'recent':
-                recent = True
-            else:
-                raise ValueException(
-                        "Don't understand command line argument \"{}\".".format(arg))
-
-    docs = create_documents(create_blog, create_cyoa, create_other)
 
     create_directories()
-    document.process_all(docs, only_recent = recent)
+    if pandoc_server:
+        processmarkdown.use_pandoc_server()
+
+    if watching:
+        try:
+            Watcher(jobs).run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            processmarkdown.converter.stop()
+        return
+
+    inputs = scan_input()
+    docs = create_documents(create_blog, create_cyoa, create_other,
+            inputs = inputs, only_changed = changed)
+
+    try:
+        document.process_all(docs, only_changed = changed, jobs = jobs)
+    finally:
+        processmarkdown.converter.stop()
+
+    if create_other:
+        remove_old_targets(inputs['main'])
+
+    # The snapshots are shared by all kinds of document, so they can only be
+    # brought up to date when everything has been built
+    if create_blog and create_cyoa and create_other:
+        for changes in inputs.values():
+            changes.save()
+
+    if gc:
+        # Every document has to be known to tell which resources are used, not
+        # only those made in this run
+        if changed or not (create_blog and create_cyoa and create_other):
+            docs = create_documents()
+        references = assetstore.References()
+        removed = references.collect_garbage(docs)
+        references.save()
+        print("Removed {} unused auto-generated resources".format(removed))
 
 if __name__ == "__main__":
     run()
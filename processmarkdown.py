@@ -3,16 +3,22 @@
 import sys
 import os
 import os.path as op
-import shutil
 import hashlib
 import json
 import base64
-
-import pandocfilters as pf
+import time
+import socket
+import subprocess
+import urllib.request
+import urllib.error
+import functools
 
 import util
 import texify
 import filelayout
+import assetstore
+import sprite
+import astvisitor
 
 png_zoom_fudge = 1.15
 png_depth_fudge = 0
@@ -46,15 +52,22 @@ png_zoom = 5
 #   title_text -- string giving the text to show on mouse over (i.e., the "title")
 #
 
-def gather_equations(j):
-    equations = []
-    def walker(key, value, format, meta):
+#
+# The passes over the pandoc json are written as transforms for astvisitor, so
+# that all of those needed at one point can be done in a single traversal.
+#
+
+def gather_equations_transform(equations):
+    def transform(key, value):
         if key == 'Math':
             latex = value[1]
             inline = (value[0]['t'] == 'InlineMath')
             equations.append(texify.LatexEquation(latex, inline))
+    return transform
 
-    pf.walk(j, walker, None, None)
+def gather_equations(j):
+    equations = []
+    astvisitor.visit(j, [gather_equations_transform(equations)])
     return equations
 
 def get_image_path(image_element):
@@ -84,103 +97,638 @@ def create_image_element(image_path, **kwargs):
             ]
         }
 
-# Returns path to the resource
-def relocate_autogenerated_resource(source, mime = None):
+# Returns path to the resource. If assets is given, the names of the files
+# placed in the store are added to it.
+def relocate_autogenerated_resource(source, mime = None, assets = None):
     assert op.isfile(source)
 
-    with open(source, 'rb') as f:
-        data = f.read()
-
-    inline = (mime is not None) and (len(data) <= 2000)
+    inline = (mime is not None) and (op.getsize(source) <= 2000)
 
     if inline:
+        with open(source, 'rb') as f:
+            data = f.read()
         b = base64.standard_b64encode(data)
         return 'data:' + mime + ';base64,' + b.decode()
     else:
-        # 16 hexadecimal digits gives 16 ** 16 == 2 ** 64 possible hashes
-        # Collisions are expected at around 2 ** 32 = 4 billion hashes
-        h = hashlib.sha256(data).hexdigest()[:16]
-
-        ext = op.splitext(source)[1]
-        name = h + ext
-
-        target = filelayout.path_to_auto_resource(name)
-        shutil.copyfile(source, target)
-
+        name = assetstore.store_file(source)
+        if assets is not None:
+            assets.add(name)
         return filelayout.link_to_auto_resource(name)
 
-def update_math(j, equations, use_png = True):
+# Returns (image_path, geometry, zoom, zoom_depth, depth_fudge, mime) for the
+# rendered image of an equation
+def math_image(equation, use_png):
+    if use_png:
+        return (equation.png_path, equation.png_geometry,
+                png_zoom / png_zoom_fudge, png_zoom, png_depth_fudge, 'image/png')
+    else:
+        return (equation.svg_path, equation.svg_geometry, 1, 1, 0, 'image/svg+xml')
+
+def math_classes(equation):
+    if equation.inline:
+        return ['inlinemath', 'math']
+    else:
+        return ['displaymath', 'math']
+
+# Shown in place of an equation which latex failed on: the source of the
+# equation, with the error from the latex log as its title
+def math_error_element(equation):
+    attrs = [['title', equation.error]]
+    return {'t' : 'Code', 'c' : [['', math_classes(equation) + ['matherror'], attrs],
+        equation.latex]}
+
+# If svg_srcset is set, the PNG image is given the SVG image as its srcset, so
+# browsers which support it show the SVG and others fall back to the PNG.
+def math_images_transform(equations, use_png, assets, svg_srcset = False):
     equation_index = [0]
 
-    def walker(key, value, format, meta):
+    def transform(key, value):
         if key == 'Math':
             equation = equations[equation_index[0]]
             equation_index[0] += 1
 
-            if use_png:
-                image_path = equation.png_path
-                geometry = equation.png_geometry
-                zoom = png_zoom / png_zoom_fudge
-                zoom_depth = png_zoom
-                depth_fudge = png_depth_fudge
-                mime = 'image/png'
-            else:
-                image_path = equation.svg_path
-                geometry = equation.svg_geometry
-                zoom = 1
-                zoom_depth = 1
-                depth_fudge = 0
-                mime = 'image/svg'
-
-            new_image_path = relocate_autogenerated_resource(image_path, mime)
+            if equation.error is not None:
+                return math_error_element(equation)
+
+            image_path, geometry, zoom, zoom_depth, depth_fudge, mime = \
+                    math_image(equation, use_png)
+
+            new_image_path = relocate_autogenerated_resource(image_path, mime, assets)
             options = {}
-            if equation.inline:
-                options['classes'] = ['inlinemath', 'math']
-            else:
-                options['classes'] = ['displaymath', 'math']
+            options['classes'] = math_classes(equation)
             options['alt_text'] = equation.alt_text()
             options['attrs'] = [
                     ['style', 'vertical-align: -{}px'.format(
                         (geometry[2] / zoom_depth) - depth_fudge)],
                     ['width', str(geometry[0] / zoom) + 'px'],
                     ['height', str((geometry[1] + geometry[2]) / zoom) + 'px']]
+            if svg_srcset:
+                options['attrs'].append(['srcset', relocate_autogenerated_resource(
+                    equation.svg_path, 'image/svg+xml', assets)])
             return create_image_element(new_image_path, **options)
 
-    return pf.walk(j, walker, None, None)
+    return transform
 
-def make_links_relative(j, relroot):
-    def walker(key, value, format, meta):
+#
+# In the sprite layout, equations are empty spans drawn with a background image
+# set by a style sheet at the top of the page. PNG equations are all packed into
+# one sprite image, so the page needs a single request (or a single data URI)
+# for all of its equations. Each distinct image gets one class in the style
+# sheet, holding its size and position, so an equation which is repeated, or a
+# data URI, is only included in the page once.
+#
+# The class names start with scope, which must differ between documents whose
+# html ends up in the same page (see WebDocument.make_fragment).
+#
+
+def math_sprite_style(equations, use_png, assets, relroot, scope = 'm'):
+    def link(path):
+        if relroot is not None and path.startswith('/'):
+            return relroot + path
+        return path
+
+    rules = ['.inlinemath.mathsprite{display:inline-block}',
+            '.displaymath.mathsprite{display:block;margin:0 auto}']
+
+    images = [math_image(equation, use_png) for equation in equations]
+    properties = []
+    for path, geometry, zoom, zoom_depth, depth_fudge, mime in images:
+        properties.append('width:{}px;height:{}px;vertical-align:-{}px'.format(
+            geometry[0] / zoom, (geometry[1] + geometry[2]) / zoom,
+            (geometry[2] / zoom_depth) - depth_fudge))
+
+    if use_png:
+        zoom = png_zoom / png_zoom_fudge
+        target = op.join(texify.workdir, 'sprite.png')
+        size, offsets = sprite.make_sprite([image[0] for image in images], target)
+        url = link(relocate_autogenerated_resource(target, 'image/png', assets))
+        os.remove(target)
+
+        rules.append('.{}.mathsprite{{background:url({}) no-repeat;background-size:{}px {}px}}'.format(
+            scope, url, size[0] / zoom, size[1] / zoom))
+        for i, offset in enumerate(offsets):
+            properties[i] += ';background-position:0 -{}px'.format(offset / zoom)
+    else:
+        for i, image in enumerate(images):
+            url = link(relocate_autogenerated_resource(image[0], image[5], assets))
+            properties[i] += ';background:url({}) no-repeat;background-size:100% 100%'.format(url)
+
+    for i in range(len(images)):
+        rules.append('.{}{}{{{}}}'.format(scope, i, properties[i]))
+
+    return '<style>\n' + '\n'.join(rules) + '\n</style>'
+
+# Adds the style sheet to j and returns the transform replacing its equations
+def math_sprite_transform(j, equations, use_png, assets, relroot, scope = 'm'):
+    # The first equation with each distinct image
+    distinct = []
+    index = {}
+    for equation in equations:
+        if equation.error is not None:
+            continue
+        path = math_image(equation, use_png)[0]
+        if path not in index:
+            index[path] = len(distinct)
+            distinct.append(equation)
+
+    if len(distinct) > 0:
+        style = math_sprite_style(distinct, use_png, assets, relroot, scope)
+        j['blocks'].insert(0, {'t' : 'RawBlock', 'c' : ['html', style]})
+
+    equation_index = [0]
+
+    def transform(key, value):
+        if key == 'Math':
+            equation = equations[equation_index[0]]
+            equation_index[0] += 1
+
+            if equation.error is not None:
+                return math_error_element(equation)
+
+            path = math_image(equation, use_png)[0]
+            classes = math_classes(equation) + ['mathsprite', scope,
+                    '{}{}'.format(scope, index[path])]
+            attrs = [['role', 'img'], ['aria-label', equation.alt_text()]]
+            return {'t' : 'Span', 'c' : [['', classes, attrs], []]}
+
+    return transform
+
+# How equations are placed in the page:
+#   'images'    -- each equation is an <img>
+#   'sprite'    -- see math_sprite_transform
+math_layout = 'images'
+
+# Which images of the equations are used, for documents which do not set their
+# own math_output:
+#   'png'       -- PNG
+#   'svg'       -- SVG
+#   'both'      -- SVG, falling back to PNG in browsers without srcset support
+#                  (the sprite layout only uses PNG)
+# Only the images which are used are rendered.
+math_output = 'png'
+
+math_output_formats = {'png' : ['png'], 'svg' : ['svg'], 'both' : ['png', 'svg']}
+
+def document_math_output(doc):
+    if doc.math_output is None:
+        return math_output
+    return doc.math_output
+
+def document_math_formats(doc):
+    if math_layout == 'sprite':
+        if document_math_output(doc) == 'svg':
+            return ['svg']
+        return ['png']
+    return math_output_formats[document_math_output(doc)]
+
+# Settings which affect the output of process_markdown for doc, and so are part
+# of its fingerprint
+def output_settings(doc):
+    return [math_layout, document_math_output(doc)]
+
+# Settings which affect the output of process_markdown for every document
+def site_settings():
+    return [math_layout, math_output]
+
+# relroot is only used for the sprite layout, where links can't be made relative
+# by make_links_relative
+def update_math_transform(j, equations, output = 'png', assets = None,
+        layout = 'images', relroot = None, scope = 'm'):
+    use_png = (output != 'svg')
+    if layout == 'sprite':
+        return math_sprite_transform(j, equations, use_png, assets, relroot, scope)
+    else:
+        return math_images_transform(equations, use_png, assets,
+                svg_srcset = (output == 'both'))
+
+def update_math(j, equations, output = 'png', assets = None, layout = 'images', relroot = None):
+    return astvisitor.visit(j, [update_math_transform(j, equations, output, assets,
+        layout, relroot)])
+
+def links_relative_transform(relroot):
+    def transform(key, value):
         if key in ['Image', 'Link']:
-            a, b, c = value
-            path, d = c
+            target = value[2]
+            if target[0].startswith('/'):
+                target[0] = relroot + target[0]
+            if key == 'Image':
+                for attr in value[0][2]:
+                    if attr[0] == 'srcset' and attr[1].startswith('/'):
+                        attr[1] = relroot + attr[1]
+    return transform
+
+def make_links_relative(j, relroot):
+    return astvisitor.visit(j, [links_relative_transform(relroot)])
 
-            if path.startswith('/'):
-                newpath = relroot + path
-                return {'t' : key, 'c' : [a, b, [newpath, d]]}
+#
+# Converters run pandoc for process_markdown. Each has two methods,
+#   markdown_to_json(doc)       -- returns the pandoc json for the source of doc
+#   json_to_html(doc, text)     -- returns the standalone html for the pandoc
+#                                  json text, using the template and variables
+#                                  of doc
+#   json_to_fragment(text)      -- returns the html for the pandoc json text
+#                                  alone, without a template
+# which return strings, and stop() to release any resources. All converters
+# produce identical output.
+#
 
-        return None
+# Runs a new pandoc process for every conversion
+class SubprocessConverter:
+    def markdown_to_json(self, doc):
+        if doc.source_data is None:
+            pandoc_result = util.call(['pandoc', '-t', 'json',
+                '-f', 'markdown', str(doc.source_path)])
+        else:
+            pandoc_result = util.call(['pandoc', '-t', 'json',
+                '-f', 'markdown'], input = doc.source_data)
+        return pandoc_result.stdout
+
+    def json_to_html(self, doc, text):
+        cmd = ['pandoc', '-s', '-f', 'json', '-t', 'html',
+                '--template', doc.template] + doc.pandoc_variable_arguments()
+        return util.call(cmd, input = text).stdout
+
+    def json_to_fragment(self, text):
+        return util.call(['pandoc', '-f', 'json', '-t', 'html'], input = text).stdout
+
+    def stop(self):
+        pass
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+# Sends conversions to a long running "pandoc server" on localhost, which avoids
+# the cost of starting pandoc for every document. Falls back to running pandoc
+# directly for any conversion where the server can't be reached.
+#
+# Note that the server is given the contents of the template rather than its
+# path, so templates which include partials must use the subprocess converter.
+class PandocServerConverter:
+    def __init__(self, port = None):
+        if port is None:
+            port = free_port()
+        self.url = 'http://localhost:{}/'.format(port)
+        self.port = port
+        self.process = None
+        self.owner = None
+        self.fallback = SubprocessConverter()
+        self.templates = {}
+
+    # Returns True if the server is up and running
+    def start(self, timeout = 10):
+        try:
+            self.process = subprocess.Popen(['pandoc', 'server',
+                '--port', str(self.port), '--timeout', '600'],
+                stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        except OSError:
+            return False
+        self.owner = os.getpid()
+
+        end = time.time() + timeout
+        while time.time() < end:
+            if self.process.poll() is not None:
+                return False
+            try:
+                socket.create_connection(('localhost', self.port), timeout = 1).close()
+                return True
+            except OSError:
+                time.sleep(0.05)
+
+        self.stop()
+        return False
+
+    def stop(self):
+        # Worker processes share the server of the process which started it
+        if self.process is not None and self.owner == os.getpid():
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+    # The server process can't be sent to worker processes, only its address
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['process'] = None
+        return state
+
+    # Returns the output, or None if the server could not be reached
+    def request(self, options):
+        data = json.dumps(options).encode('utf8')
+        headers = {'Content-Type' : 'application/json', 'Accept' : 'application/json'}
+        try:
+            with urllib.request.urlopen(urllib.request.Request(self.url,
+                    data = data, headers = headers)) as response:
+                result = json.loads(response.read().decode('utf8'))
+        except urllib.error.HTTPError as e:
+            raise Exception("pandoc server failed: " + e.read().decode('utf8', 'replace'))
+        except OSError:
+            return None
+        return result['output']
+
+    def template(self, path):
+        if path not in self.templates:
+            with open(path, 'r') as f:
+                self.templates[path] = f.read()
+        return self.templates[path]
+
+    # Same as the -V arguments: no value means true, and a repeated key a list
+    def variables(self, doc):
+        variables = {}
+        for key, value in doc.meta_variables:
+            if value is None:
+                value = True
+            else:
+                value = str(value)
+            if key not in variables:
+                variables[key] = value
+            elif type(variables[key]) is list:
+                variables[key].append(value)
+            else:
+                variables[key] = [variables[key], value]
+        return variables
+
+    def markdown_to_json(self, doc):
+        if doc.source_data is None:
+            with open(doc.source_path, 'r') as f:
+                text = f.read()
+        else:
+            text = doc.source_data
+
+        output = self.request({'text' : text, 'from' : 'markdown', 'to' : 'json'})
+        if output is None:
+            return self.fallback.markdown_to_json(doc)
+        return output
+
+    def json_to_html(self, doc, text):
+        output = self.request({'text' : text, 'from' : 'json', 'to' : 'html',
+            'standalone' : True, 'template' : self.template(doc.template),
+            'variables' : self.variables(doc)})
+        if output is None:
+            return self.fallback.json_to_html(doc, text)
+        # The pandoc executable ends its output with a newline, the server does not
+        if not output.endswith('\n'):
+            output += '\n'
+        return output
+
+    def json_to_fragment(self, text):
+        output = self.request({'text' : text, 'from' : 'json', 'to' : 'html'})
+        if output is None:
+            return self.fallback.json_to_fragment(text)
+        if not output.endswith('\n'):
+            output += '\n'
+        return output
+
+converter = SubprocessConverter()
+
+def set_converter(c):
+    global converter
+    converter = c
+
+# The settings of this module, to be passed on to worker processes
+def worker_settings():
+    return {'converter' : converter, 'math_layout' : math_layout,
+            'math_output' : math_output, 'batch_documents' : batch_documents}
+
+def apply_worker_settings(settings):
+    globals().update(settings)
+
+# Returns True if the pandoc server is being used; otherwise pandoc continues
+# to be run as a subprocess.
+def use_pandoc_server():
+    c = PandocServerConverter()
+    if not c.start():
+        print("Could not start pandoc server, running pandoc directly instead")
+        return False
+    set_converter(c)
+    return True
+
+#
+# The pandoc json for a markdown document only depends on the markdown and the
+# version of pandoc, so it is cached in ast_cache_dir under the hash of those.
+#
 
-    return pf.walk(j, walker, None, None)
+@functools.lru_cache(maxsize = None)
+def pandoc_version():
+    return util.call(['pandoc', '--version']).stdout.splitlines()[0]
 
-def process_markdown(doc, relative = True):
+def markdown_source(doc):
     if doc.source_data is None:
-        pandoc_result = util.call(['pandoc', '-t', 'json',
-            '-f', 'markdown', str(doc.source_path)])
+        with open(doc.source_path, 'r') as f:
+            return f.read()
     else:
-        pandoc_result = util.call(['pandoc', '-t', 'json',
-            '-f', 'markdown'], input = doc.source_data)
+        return doc.source_data
+
+def ast_cache_path(markdown):
+    text = pandoc_version() + '\n' + markdown
+    h = hashlib.sha256(text.encode('utf8')).hexdigest()
+    return op.join(filelayout.ast_cache_dir, h + '.json')
+
+# Returns True if the pandoc json was found in the cache
+def parse_markdown(doc):
+    path = ast_cache_path(markdown_source(doc))
+    hit = op.isfile(path)
+
+    if hit:
+        with open(path, 'r') as f:
+            doc.ast = json.load(f)
+    else:
+        doc.ast = json.loads(converter.markdown_to_json(doc))
+        store_ast(path, doc.ast)
+
+    doc.equations = gather_equations(doc.ast)
+    return hit
+
+def store_ast(path, ast):
+    util.write_atomic(path, lambda f : json.dump(ast, f, separators = (',', ':')))
+
+# Makes equations which appear more than once among the given (already parsed)
+# documents, in the same document or in different ones, share a single
+# LatexEquation, and sets the formats each needs to be rendered in. Returns the
+# list of distinct equations.
+def share_equations(docs):
+    unique = {}
+    for doc in docs:
+        formats = document_math_formats(doc)
+        for i, equation in enumerate(doc.equations):
+            key = (equation.latex, equation.inline)
+            if key in unique:
+                doc.equations[i] = unique[key]
+            else:
+                unique[key] = equation
+            unique[key].formats.update(formats)
+    return list(unique.values())
+
+# Equations needing the same formats are rendered together, so a format is
+# only rendered for the equations which need it
+def make_equation_images(equations):
+    groups = {}
+    for equation in equations:
+        groups.setdefault(tuple(sorted(equation.formats)), []).append(equation)
+
+    for formats, group in groups.items():
+        texify.makeimages(group, make_png = 'png' in formats,
+                make_svg = 'svg' in formats, png_dpi = int(96 * png_zoom))
+    return equations
+
+# Renders the equations of all of the given documents in a single batch, so that
+# each distinct equation is only typeset once.
+def render_equations(docs):
+    make_equation_images(share_equations(docs))
 
-    j = json.loads(pandoc_result.stdout)
+#
+# A document with make_fragment set also leaves the html of its body, without
+# the template, in fragment_cache_dir, for inclusion in other documents (see
+# WebDocument.parts). Fragments are named by WebDocument.fragment_fingerprint,
+# so one which exists is up to date.
+#
+
+def write_fragment(path, html):
+    util.write_atomic(path, lambda f : f.write(html))
 
-    equations = gather_equations(j)
-    texify.makeimages(equations, make_png = True, make_svg = True, png_dpi = int(96 * png_zoom))
-    j_new = update_math(j, equations)
+# Applies the transforms to the pandoc json of doc, and returns it as text
+def transform_markdown(doc, relative = True):
+    doc.assets = set()
 
+    scope = 'm'
+    if doc.make_fragment:
+        scope = 'm' + doc.fragment_fingerprint()[:8] + '-'
+
+    visitor = astvisitor.Visitor()
+    visitor.register(update_math_transform(doc.ast, doc.equations,
+        output = document_math_output(doc), assets = doc.assets,
+        layout = math_layout, relroot = doc.relroot if relative else None,
+        scope = scope))
     if relative:
-        j_new = make_links_relative(j_new, doc.relroot)
+        visitor.register(links_relative_transform(doc.relroot))
+    j_new = visitor.run(doc.ast)
+
+    doc.ast = None
+    doc.equations = None
+
+    return json.dumps(j_new)
+
+# Makes the html of doc from the transformed pandoc json text
+def convert_html(doc, text):
+    doc.target_data = converter.json_to_html(doc, text)
+    if doc.make_fragment:
+        write_fragment(doc.fragment_path(), converter.json_to_fragment(text))
+
+def finish_markdown(doc, relative = True):
+    convert_html(doc, transform_markdown(doc, relative))
+
+#
+# Many small documents (a cyoa location or a short blog post is often a few
+# lines) can be converted by a single pandoc process, running pandocbatch.lua,
+# instead of starting pandoc once for every document at each stage. Each
+# document is still read and written by pandoc on its own, so the output is the
+# same. This needs "pandoc lua" (pandoc 3.1 or later); if a batch fails, its
+# documents are converted one by one by the converter.
+#
+
+batch_documents = False
 
-    cmd = ['pandoc', '-s', '-f', 'json', '-t', 'html',
-            '--template', doc.template] + doc.pandoc_variable_arguments()
-    pandoc_result = util.call(cmd, input = json.dumps(j_new))
+# Documents with more markdown than this are not worth batching
+batch_max_bytes = 20000
+batch_max_count = 200
 
-    doc.target_data = pandoc_result.stdout
+batch_script = op.join(op.dirname(op.abspath(__file__)), 'pandocbatch.lua')
+
+def source_size(doc):
+    if doc.source_data is None:
+        return op.getsize(doc.source_path)
+    return len(doc.source_data)
+
+def batchable(doc):
+    return (batch_documents and doc.is_markdown and doc.parts is None and
+            source_size(doc) <= batch_max_bytes)
+
+# Splits docs into lists to be converted together, with at least one list for
+# each of the jobs if possible. Documents which are not batchable are alone.
+def make_batches(docs, jobs = 1):
+    small = [doc for doc in docs if batchable(doc)]
+    count = max(jobs, (len(small) + batch_max_count - 1) // batch_max_count)
+    batches = [small[i::count] for i in range(min(count, len(small)))]
+    return batches + [[doc] for doc in docs if not batchable(doc)]
+
+# Returns the outputs for the records, or None if the batch failed
+def run_batch(mode, records):
+    if len(records) == 0:
+        return []
+
+    separator = 'pandoc-batch-' + os.urandom(16).hex()
+    text = ''.join(record + '\n' + separator + '\n' for record in records)
+    try:
+        result = util.call(['pandoc', 'lua', batch_script, mode, separator],
+                report_errors = False, input = text)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print("Batch of {} conversions failed, doing them one by one: {}".format(
+            len(records), e))
+        return None
+
+    outputs = result.stdout.split('\n' + separator + '\n')
+    if len(outputs) != len(records) + 1 or outputs[-1] != '':
+        print("Batch of {} conversions returned {} outputs, doing them one by one".format(
+            len(records), len(outputs) - 1))
+        return None
+    return [output + '\n' for output in outputs[:-1]]
+
+# Puts the pandoc json of those of the documents which are not in the cache in
+# the cache, converting them as a batch. Returns the list of those documents.
+def parse_markdown_batch(docs):
+    missing = []
+    for doc in docs:
+        source = markdown_source(doc)
+        path = ast_cache_path(source)
+        if not op.isfile(path):
+            missing.append((doc, source, path))
+
+    if len(missing) < 2:
+        return []
+    outputs = run_batch('json', [source for doc, source, path in missing])
+    if outputs is None:
+        return []
+
+    for (doc, source, path), output in zip(missing, outputs):
+        store_ast(path, json.loads(output))
+    return [doc for doc, source, path in missing]
+
+def html_batch_record(template, variables, text):
+    lines = [template, str(len(variables))]
+    for key, value in variables:
+        if value is None:
+            lines.append(key)
+        else:
+            lines.append('{}={}'.format(key, value))
+    return '\n'.join(lines) + '\n' + text
+
+# Does convert_html for each of the (doc, text) as a batch. The documents which
+# could not be converted are left without target_data.
+def convert_html_batch(items):
+    records = []
+    for doc, text in items:
+        if any('\n' in '{}{}'.format(key, value) for key, value in doc.meta_variables):
+            continue
+        records.append((doc, text, html_batch_record(doc.template, doc.meta_variables, text)))
+        if doc.make_fragment:
+            records.append((doc, None, html_batch_record('', [], text)))
+
+    if len(records) < 2:
+        return
+    outputs = run_batch('html', [record for doc, text, record in records])
+    if outputs is None:
+        return
+
+    for (doc, text, record), output in zip(records, outputs):
+        if text is None:
+            write_fragment(doc.fragment_path(), output)
+        else:
+            doc.target_data = output
+
+# If the document has already been through parse_markdown and render_equations
+# (as part of a batch with other documents) only the last step is done here.
+def process_markdown(doc, relative = True):
+    if doc.ast is None:
+        parse_markdown(doc)
+        render_equations([doc])
+    finish_markdown(doc, relative)
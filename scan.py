@@ -0,0 +1,108 @@
+import os
+import os.path as op
+import json
+
+import util
+import filelayout
+
+#
+# Discovery of input files. A directory tree is listed with os.scandir, using
+# the stat information of the directory entries, and compared with a snapshot
+# saved by the previous build, holding for each file
+#   stat    -- [size, mtime in nanoseconds, inode]
+#   hash    -- sha256 of the contents
+# Files are only read (to hash them) if their stat information has changed, and
+# a file whose contents are the same after all (for example after a touch) is
+# not reported as changed.
+#
+# The snapshot also records the settings the build was made with; if they are
+# different every file is reported as changed.
+#
+
+# Returns a dictionary from path to stat information of the files under root
+# for which valid(filename) is true. Like os.walk, symbolic links to
+# directories are not followed.
+def scan(root, valid, recursive = True):
+    files = {}
+    if not op.isdir(root):
+        return files
+
+    stack = [root]
+    while len(stack) > 0:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if recursive and not entry.is_symlink():
+                        stack.append(entry.path)
+                elif valid(entry.name):
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    files[entry.path] = [st.st_size, st.st_mtime_ns, st.st_ino]
+    return files
+
+class Changes:
+    def __init__(self, snapshot, files, added, changed, removed):
+        self.snapshot = snapshot
+
+        # path -> {'stat' : ..., 'hash' : ...} for every file present
+        self.files = files
+
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+
+    def is_modified(self, path):
+        return (path in self.added) or (path in self.changed)
+
+    def any(self):
+        return len(self.added) + len(self.changed) + len(self.removed) > 0
+
+    # Records the files as they are now, once the build has succeeded
+    def save(self):
+        self.snapshot.save(self.files)
+
+class Snapshot:
+    def __init__(self, name):
+        self.path = op.join(filelayout.working_dir, 'snapshot_{}.json'.format(name))
+        self.settings = None
+        self.files = {}
+
+        if op.isfile(self.path):
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self.settings = data['settings']
+            self.files = data['files']
+
+    def scan(self, root, valid, settings, recursive = True):
+        self.new_settings = settings
+        everything = (settings != self.settings)
+
+        files = {}
+        added = set()
+        changed = set()
+        for path, stat in scan(root, valid, recursive).items():
+            old = self.files.get(path)
+            if old is not None and old['stat'] == stat:
+                h = old['hash']
+            else:
+                h = util.sha256_file(path)
+            files[path] = {'stat' : stat, 'hash' : h}
+
+            if old is None:
+                added.add(path)
+            elif everything or old['hash'] != h:
+                changed.add(path)
+
+        removed = set(path for path in self.files if path not in files)
+
+        return Changes(self, files, added, changed, removed)
+
+    def save(self, files):
+        self.settings = self.new_settings
+        self.files = files
+
+        data = {'settings' : self.new_settings, 'files' : files}
+        util.write_atomic(self.path, lambda f : json.dump(data, f,
+            indent = 0, sort_keys = True))
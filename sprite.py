@@ -0,0 +1,181 @@
+import struct
+import zlib
+
+#
+# Packs several PNG images into a single PNG (a "sprite sheet"), so that a page
+# with many equations needs only one image. The images are stacked vertically,
+# with a small transparent gap between them so that scaling one image in the
+# browser does not bleed in pixels of its neighbours.
+#
+# Only as much of PNG as is produced by dvipng is needed, so decoding supports
+# all colour types and bit depths but not interlacing.
+#
+
+png_signature = b'\x89PNG\r\n\x1a\n'
+
+gap = 2
+
+def read_chunks(data):
+    if not data.startswith(png_signature):
+        raise ValueError("Not a PNG file")
+    pos = len(png_signature)
+    while pos < len(data):
+        length, kind = struct.unpack('>I4s', data[pos : pos + 8])
+        yield kind, data[pos + 8 : pos + 8 + length]
+        pos += 12 + length
+
+def paeth(a, b, c):
+    p = a + b - c
+    pa = abs(p - a)
+    pb = abs(p - b)
+    pc = abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    elif pb <= pc:
+        return b
+    else:
+        return c
+
+# Undoes the per-row filters, returns the list of rows
+def unfilter(data, height, row_bytes, bpp):
+    rows = []
+    prev = bytearray(row_bytes)
+    pos = 0
+    for y in range(height):
+        filter_type = data[pos]
+        line = bytearray(data[pos + 1 : pos + 1 + row_bytes])
+        pos += 1 + row_bytes
+
+        if filter_type == 1:
+            for i in range(bpp, row_bytes):
+                line[i] = (line[i] + line[i - bpp]) & 255
+        elif filter_type == 2:
+            for i in range(row_bytes):
+                line[i] = (line[i] + prev[i]) & 255
+        elif filter_type == 3:
+            for i in range(row_bytes):
+                left = line[i - bpp] if i >= bpp else 0
+                line[i] = (line[i] + ((left + prev[i]) >> 1)) & 255
+        elif filter_type == 4:
+            for i in range(row_bytes):
+                if i >= bpp:
+                    line[i] = (line[i] + paeth(line[i - bpp], prev[i], prev[i - bpp])) & 255
+                else:
+                    line[i] = (line[i] + prev[i]) & 255
+        elif filter_type != 0:
+            raise ValueError("Unknown PNG filter type {}".format(filter_type))
+
+        rows.append(line)
+        prev = line
+    return rows
+
+def samples(line, width, channels, depth):
+    count = width * channels
+    if depth == 8:
+        return line[:count]
+    elif depth == 16:
+        return [(line[2 * i] << 8) | line[2 * i + 1] for i in range(count)]
+    else:
+        per_byte = 8 // depth
+        mask = (1 << depth) - 1
+        result = []
+        for byte in line:
+            for k in range(per_byte):
+                result.append((byte >> (8 - depth * (k + 1))) & mask)
+        return result[:count]
+
+# Returns (width, height, rows) where each row is a bytearray of RGBA values
+def read_png(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    idat = []
+    palette = None
+    transparency = None
+    for kind, chunk in read_chunks(data):
+        if kind == b'IHDR':
+            width, height, depth, colour, _, _, interlace = struct.unpack('>IIBBBBB', chunk)
+        elif kind == b'PLTE':
+            palette = chunk
+        elif kind == b'tRNS':
+            transparency = chunk
+        elif kind == b'IDAT':
+            idat.append(chunk)
+
+    if interlace != 0:
+        raise ValueError("Interlaced PNG files are not supported")
+
+    channels = {0 : 1, 2 : 3, 3 : 1, 4 : 2, 6 : 4}[colour]
+    bits = channels * depth
+    row_bytes = (width * bits + 7) // 8
+    bpp = max(1, bits // 8)
+    lines = unfilter(zlib.decompress(b''.join(idat)), height, row_bytes, bpp)
+
+    if colour == 3:
+        alphas = bytearray([255] * 256)
+        if transparency is not None:
+            alphas[:len(transparency)] = transparency
+        lookup = [bytes(palette[3 * i : 3 * i + 3]) + bytes([alphas[i]])
+                for i in range(len(palette) // 3)]
+    elif colour in [0, 2] and transparency is not None:
+        # The transparent colour, in the same units as the samples
+        key = struct.unpack('>' + 'H' * (len(transparency) // 2), transparency)
+    else:
+        key = None
+
+    # Samples scaled to 8 bits
+    maximum = (1 << depth) - 1
+    to8 = [v >> 8 if depth == 16 else v * 255 // maximum for v in range(maximum + 1)]
+
+    rows = []
+    for line in lines:
+        s = samples(line, width, channels, depth)
+        row = bytearray()
+        for x in range(width):
+            p = s[x * channels : (x + 1) * channels]
+            if colour == 3:
+                row += lookup[p[0]]
+            elif colour == 0:
+                g = to8[p[0]]
+                row += bytes([g, g, g, 0 if key == tuple(p) else 255])
+            elif colour == 2:
+                row += bytes([to8[p[0]], to8[p[1]], to8[p[2]], 0 if key == tuple(p) else 255])
+            elif colour == 4:
+                row += bytes([to8[p[0]], to8[p[0]], to8[p[0]], to8[p[1]]])
+            else:
+                row += bytes(to8[v] for v in p)
+        rows.append(row)
+
+    return width, height, rows
+
+def png_chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+def write_png(path, width, height, rows):
+    raw = b''.join(b'\x00' + bytes(row) for row in rows)
+    data = (png_signature +
+            png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) +
+            png_chunk(b'IDAT', zlib.compress(raw, 9)) +
+            png_chunk(b'IEND', b''))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+# Writes the sprite sheet made from the images at paths to target. Returns
+# the size (width, height) of the sprite and, for each image, its vertical
+# offset in the sprite.
+def make_sprite(paths, target):
+    images = [read_png(path) for path in paths]
+
+    width = max(image[0] for image in images)
+    rows = []
+    offsets = []
+    for w, h, image_rows in images:
+        if len(rows) > 0:
+            rows.extend(bytearray(4 * width) for i in range(gap))
+        offsets.append(len(rows))
+        for row in image_rows:
+            rows.append(row + bytearray(4 * (width - w)))
+
+    write_png(target, width, len(rows), rows)
+    return (width, len(rows)), offsets
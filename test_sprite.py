@@ -0,0 +1,137 @@
+import os
+import random
+import struct
+import tempfile
+import zlib
+
+import sprite
+
+#
+# A check of read_png and write_png in sprite.py, run with pytest or as
+# "python test_sprite.py". PNG files of every colour type and bit depth, using
+# every filter type, are encoded here independently of read_png, and must
+# decode to the expected RGBA values. The decoded images must then survive a
+# round trip through write_png.
+#
+
+# Packs rows of samples into the bytes of a PNG, using each filter type in turn
+def encode_rows(rows, depth, channels):
+    bpp = max(1, channels * depth // 8)
+    data = bytearray()
+    prev = None
+    for y, row in enumerate(rows):
+        raw = bytearray()
+        if depth == 16:
+            for v in row:
+                raw += struct.pack('>H', v)
+        elif depth == 8:
+            raw += bytes(row)
+        else:
+            per_byte = 8 // depth
+            for i in range(0, len(row), per_byte):
+                byte = 0
+                for k, v in enumerate(row[i : i + per_byte]):
+                    byte |= v << (8 - depth * (k + 1))
+                raw.append(byte)
+        if prev is None:
+            prev = bytearray(len(raw))
+
+        filter_type = y % 5
+        line = bytearray()
+        for i in range(len(raw)):
+            left = raw[i - bpp] if i >= bpp else 0
+            up = prev[i]
+            up_left = prev[i - bpp] if i >= bpp else 0
+            predictor = [0, left, up, (left + up) >> 1,
+                    sprite.paeth(left, up, up_left)][filter_type]
+            line.append((raw[i] - predictor) & 255)
+        data += bytes([filter_type]) + line
+        prev = raw
+    return bytes(data)
+
+def encode_png(width, height, depth, colour, rows, palette = None, transparency = None):
+    channels = {0 : 1, 2 : 3, 3 : 1, 4 : 2, 6 : 4}[colour]
+    data = (sprite.png_signature +
+            sprite.png_chunk(b'IHDR', struct.pack('>IIBBBBB',
+                width, height, depth, colour, 0, 0, 0)))
+    if palette is not None:
+        data += sprite.png_chunk(b'PLTE', palette)
+    if transparency is not None:
+        data += sprite.png_chunk(b'tRNS', transparency)
+    # Split into two IDAT chunks, which read_png must join
+    compressed = zlib.compress(encode_rows(rows, depth, channels))
+    half = len(compressed) // 2
+    return (data + sprite.png_chunk(b'IDAT', compressed[:half]) +
+            sprite.png_chunk(b'IDAT', compressed[half:]) + sprite.png_chunk(b'IEND', b''))
+
+# Returns (png data, expected RGBA rows) for a random image
+def make_case(generator, width, height, depth, colour):
+    maximum = (1 << depth) - 1
+    channels = {0 : 1, 2 : 3, 3 : 1, 4 : 2, 6 : 4}[colour]
+    rows = [[generator.randint(0, maximum) for i in range(width * channels)]
+            for y in range(height)]
+
+    def to8(v):
+        return v >> 8 if depth == 16 else v * 255 // maximum
+
+    palette = None
+    transparency = None
+    key = None
+    if colour == 3:
+        palette = bytes(generator.randint(0, 255) for i in range(3 * (maximum + 1)))
+        alphas = [generator.randint(0, 255) for i in range((maximum + 1) // 2)]
+        transparency = bytes(alphas)
+    elif colour in [0, 2]:
+        # The colour of the first pixel is transparent, and the last pixel
+        # differs from it only in the lowest bit, so it must stay opaque
+        key = rows[0][:channels]
+        transparency = struct.pack('>' + 'H' * channels, *key)
+        if width * height > 1:
+            rows[-1][-channels:] = [v ^ 1 for v in key]
+
+    expected = []
+    for row in rows:
+        e = bytearray()
+        for x in range(width):
+            p = row[x * channels : (x + 1) * channels]
+            if colour == 3:
+                alpha = alphas[p[0]] if p[0] < len(alphas) else 255
+                e += palette[3 * p[0] : 3 * p[0] + 3] + bytes([alpha])
+            elif colour == 0:
+                e += bytes([to8(p[0])] * 3 + [0 if p == key else 255])
+            elif colour == 2:
+                e += bytes([to8(v) for v in p] + [0 if p == key else 255])
+            elif colour == 4:
+                e += bytes([to8(p[0])] * 3 + [to8(p[1])])
+            else:
+                e += bytes(to8(v) for v in p)
+        expected.append(e)
+
+    return encode_png(width, height, depth, colour, rows, palette, transparency), expected
+
+def test_round_trip():
+    depths = {0 : [1, 2, 4, 8, 16], 2 : [8, 16], 3 : [1, 2, 4, 8], 4 : [8, 16], 6 : [8, 16]}
+    generator = random.Random(0)
+    count = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'image.png')
+        for colour in sorted(depths):
+            for depth in depths[colour]:
+                # Odd widths leave the last byte of a row partly unused
+                for width, height in [(1, 1), (7, 10), (13, 6)]:
+                    data, expected = make_case(generator, width, height, depth, colour)
+                    with open(path, 'wb') as f:
+                        f.write(data)
+                    name = "colour type {}, depth {}, {}x{}".format(
+                            colour, depth, width, height)
+                    if sprite.read_png(path) != (width, height, expected):
+                        raise AssertionError("read_png is wrong for " + name)
+
+                    sprite.write_png(path, width, height, expected)
+                    if sprite.read_png(path) != (width, height, expected):
+                        raise AssertionError("write_png does not round trip for " + name)
+                    count += 1
+    print("{} images checked".format(count))
+
+if __name__ == "__main__":
+    test_round_trip()
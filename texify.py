@@ -3,9 +3,14 @@ import os
 import os.path
 import subprocess
 import re
+import shutil
+import hashlib
+import json
+import tempfile
+import functools
 
 import util
-from filelayout import latex_dir
+from filelayout import latex_dir, equation_cache_dir, latex_format_dir
 
 #
 # For some reason the first equation in a preview environment seems to get
@@ -14,12 +19,14 @@ from filelayout import latex_dir
 #
 
 # \\documentclass[fontsize=12pt, fleqn]{scrartcl}
-latex_header = """
+latex_preamble = """
 \\documentclass[fontsize=12pt, fleqn]{article}
 \\usepackage{amsmath}
 \\usepackage{amssymb}
 \\usepackage[active,tightpage]{preview}
-\\begin{document}
+"""
+
+latex_begin = """\\begin{document}
 
 \\large
 
@@ -30,6 +37,8 @@ $ignore$
 
 """
 
+latex_header = latex_preamble + latex_begin
+
 latex_body = """
 \\begin{{preview}}
 \\noindent
@@ -50,6 +59,16 @@ class LatexEquation:
         self.png_path = None
         self.png_geometry = None
 
+        # Formats ('png' and/or 'svg') the equation is needed in
+        self.formats = set()
+
+        # If latex fails on the equation, the relevant part of its log
+        self.error = None
+
+        # Set if the equation could not be rendered for a reason other than an
+        # error in it, such as dvipng failing, so the error is not its fault
+        self.broken = False
+
     def alt_text(self):
         if len(self.latex) > 200:
             return self.latex[:197] + '...'
@@ -62,15 +81,91 @@ class LatexEquation:
         else:
             return '\\displaystyle ' + self.latex
 
-def latex_document(equations):
-    assert len(equations) > 0
+# If with_preamble is False the document is meant to be run with the format
+# made by preamble_format, which already contains the preamble. With no
+# equations the document only has the dummy one.
+def latex_document(equations, with_preamble = True):
     body = [latex_body.format(equation.to_code()) for equation in equations]
-    return ''.join([latex_header] + body + [latex_footer])
+    if with_preamble:
+        header = latex_header
+    else:
+        header = latex_begin
+    return ''.join([header] + body + [latex_footer])
 
-def remove_old_files():
+#
+# Loading the document class and packages of the preamble is a large part of
+# the time latex takes for a small document, so the state after the preamble
+# is dumped to a format file (using the mylatexformat package) which later runs
+# of latex start from. The format is kept in latex_format_dir under a name
+# derived from the preamble and the TeX installation, so it is made again when
+# either of those changes.
+#
+
+use_format = True
+
+# Returns the name of the format, or None if it could not be made
+@functools.lru_cache(maxsize = None)
+def preamble_format():
+    try:
+        version = util.call(['latex', '--version'],
+                report_errors = False).stdout.splitlines()[0]
+        base_format = util.call(['kpsewhich', 'latex.fmt'],
+                report_errors = False).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    installation = [version, base_format, str(os.path.getmtime(base_format))]
+
+    text = '\n'.join([latex_preamble] + installation)
+    name = 'texify-' + hashlib.sha256(text.encode('utf8')).hexdigest()[:16]
+    target = os.path.join(latex_format_dir, name + '.fmt')
+    if os.path.isfile(target):
+        return name
+
+    # Made in a private directory, as other processes may be doing the same
+    tmp = tempfile.mkdtemp(dir = latex_format_dir)
+    try:
+        with open(os.path.join(tmp, name + '.tex'), 'w') as f:
+            f.write(latex_preamble + '\\begin{document}\n\\end{document}\n')
+        util.call(['latex', '-ini', '-halt-on-error', '-jobname=' + name,
+            '&latex', 'mylatexformat.ltx', name + '.tex'], cwd = tmp)
+        os.replace(os.path.join(tmp, name + '.fmt'), target)
+    except (OSError, subprocess.CalledProcessError):
+        print("Could not make a latex format for the preamble, continuing without")
+        return None
+    finally:
+        shutil.rmtree(tmp, ignore_errors = True)
+
+    return name
+
+# Returns the command and extra options for util.call to run latex on filename,
+# and whether the document needs to include the preamble (that is, whether the
+# format is not used)
+def latex_command(filename):
+    fmt = preamble_format() if use_format else None
+    if fmt is None:
+        return ['latex', '-halt-on-error', filename], {}, True
+    else:
+        # Formats are searched for in TEXFORMATS, and then the usual places
+        env = dict(os.environ, TEXFORMATS = latex_format_dir + os.pathsep)
+        return ['latex', '-halt-on-error', '-fmt=' + fmt, filename], {'env' : env}, False
+
+# Directory in which latex is run. Worker processes each get a private one (see
+# use_private_workdir) so that they do not overwrite each other's files.
+workdir = latex_dir
+
+def use_private_workdir():
+    global workdir
+    workdir = tempfile.mkdtemp(prefix = 'worker-', dir = latex_dir)
+
+def remove_private_workdirs():
     for filename in os.listdir(latex_dir):
+        if filename.startswith('worker-'):
+            shutil.rmtree(os.path.join(latex_dir, filename), ignore_errors = True)
+
+def remove_old_files():
+    for filename in os.listdir(workdir):
         if filename.endswith('.svg') or filename.endswith('.png'):
-            os.remove(os.path.join(latex_dir, filename))
+            os.remove(os.path.join(workdir, filename))
 
 _dvisvgm_re = re.compile('  width=(\\d*\\.\\d+)pt, height=(\\d*\\.\\d+)pt, depth=(\\d*\\.\\d+)pt')
 def parse_dvisvgm_stderr(output):
@@ -91,57 +186,216 @@ def parse_dvipng_stdout(output):
         result.append((int(width), int(height), int(depth)))
     return result
 
-def makeimages(equations, make_svg = False, make_png = True, png_dpi = 96):
-    N = len(equations)
-    if N == 0 or not (make_svg or make_png):
-        return
-
-    remove_old_files()
+# The lines of the log from the first error message on
+def log_excerpt(log, lines = 12):
+    log = log.splitlines()
+    for i, line in enumerate(log):
+        if line.startswith('!'):
+            return '\n'.join(log[i : i + lines])
+    return '\n'.join(log[-lines:])
 
-    basename = 'equations'
+# Runs latex on a document with the given equations, producing basename.dvi.
+# Returns None if it succeeded, or otherwise an excerpt of the log.
+def run_latex(equations, basename):
     filename = basename + '.tex'
-    fp = os.path.join(latex_dir, filename)
-    with open(fp, 'w') as f:
-        f.write(latex_document(equations))
+    cmd, options, with_preamble = latex_command(filename)
+    with open(os.path.join(workdir, filename), 'w') as f:
+        f.write(latex_document(equations, with_preamble = with_preamble))
 
     try:
-        util.call(['latex', '-halt-on-error', filename], cwd = latex_dir)
+        util.call(cmd, cwd = workdir, report_errors = False, **options)
     except subprocess.CalledProcessError:
+        log_path = os.path.join(workdir, basename + '.log')
+        if os.path.isfile(log_path):
+            with open(log_path, 'r', errors = 'replace') as f:
+                return log_excerpt(f.read())
+        return 'latex failed'
+    return None
+
+# Given equations which latex fails on with the given error, splits them in
+# halves until the equations at fault are found, and sets their error
+def find_failures(equations, error, basename):
+    if len(equations) == 1:
+        equations[0].error = error
+        return
+
+    for half in [equations[: len(equations) // 2], equations[len(equations) // 2 :]]:
+        half_error = run_latex(half, basename)
+        if half_error is not None:
+            find_failures(half, half_error, basename)
+
+# Sets the error of the equations which latex fails on, and returns the rest
+# after running latex on them all together. If latex fails even without any of
+# the equations (say, a package is missing), the equations are not at fault, so
+# they are all marked broken instead of being bisected.
+def run_latex_isolating_failures(equations, basename):
+    error = run_latex(equations, basename)
+    if error is None:
+        return equations
+
+    header_error = run_latex([], basename)
+    if header_error is not None:
+        print("**Failed to typeset the latex header")
+        print(header_error)
+        for equation in equations:
+            equation.error = header_error
+            equation.broken = True
+        return []
+
+    find_failures(equations, error, basename)
+    for equation in equations:
+        if equation.error is not None:
+            print("**Failed to typeset equation: ${}$".format(equation.latex))
+            print(equation.error)
+
+    good = [equation for equation in equations if equation.error is None]
+    if len(good) == 0:
+        return good
+
+    error = run_latex(good, basename)
+    if error is not None:
+        # The equations only fail when together, so give up on all of them
+        for equation in good:
+            equation.error = error
+        return []
+    return good
+
+# The page of the document an image made by dvipng or dvisvgm is of, from its
+# filename (basename-<page>.ext). The page numbers are only padded to four
+# digits, so the filenames can't be sorted as strings.
+def page_number(filename):
+    return int(os.path.splitext(filename)[0].rsplit('-', 1)[1])
+
+# Equations which latex fails on get an error instead of images
+def render(equations, make_svg = False, make_png = True, png_dpi = 96):
+    if len(equations) == 0 or not (make_svg or make_png):
+        return
+
+    remove_old_files()
+
+    basename = 'equations'
+    equations = run_latex_isolating_failures(equations, basename)
+    N = len(equations)
+    if N == 0:
         return
 
     if make_svg:
         dvisvgm_cmd = ['dvisvgm', '--no-fonts', '--exact-bbox', '--page=-',
                 '--bbox=preview', '--output=%f-%4p.svg', basename + '.dvi']
-        dvisvgm_result = util.call(dvisvgm_cmd, cwd = latex_dir)
+        dvisvgm_result = util.call(dvisvgm_cmd, cwd = workdir)
         geometry = parse_dvisvgm_stderr(dvisvgm_result.stderr)
         assert len(geometry) == N + 1
 
         images = []
-        for filename in os.listdir(latex_dir):
+        for filename in os.listdir(workdir):
             if filename.endswith('.svg'):
                 images.append(filename)
         assert len(images) == N + 1
-        images.sort()
+        images.sort(key = page_number)
 
         for i in range(N):
-            equations[i].svg_path = os.path.join(latex_dir, images[i + 1])
+            equations[i].svg_path = os.path.join(workdir, images[i + 1])
             equations[i].svg_geometry = geometry[i + 1] # Tuple of width, height, depth
 
     if make_png:
         dvipng_cmd = ['dvipng', '--width', '--height', '--depth', '-D', str(png_dpi),
                 '-T', 'tight', '-z', '9', '--gamma', '3',
                 '-q', '-o', basename + '-%04d.png', basename + '.dvi']
-        dvipng_result = util.call(dvipng_cmd, cwd = latex_dir)
+        dvipng_result = util.call(dvipng_cmd, cwd = workdir)
         geometry = parse_dvipng_stdout(dvipng_result.stdout)
         assert len(geometry) == N + 1
 
         images = []
-        for filename in os.listdir(latex_dir):
+        for filename in os.listdir(workdir):
             if filename.endswith('.png'):
                 images.append(filename)
         assert len(images) == N + 1
-        images.sort()
+        images.sort(key = page_number)
 
         for i in range(N):
-            equations[i].png_path = os.path.join(latex_dir, images[i + 1])
+            equations[i].png_path = os.path.join(workdir, images[i + 1])
             equations[i].png_geometry = geometry[i + 1] # Tuple of width, height, depth
+
+#
+# Rendered equations are cached in equation_cache_dir, so that an equation
+# which has not changed since the last build never has to go through TeX again.
+# Each entry consists of
+#   <key>.png or <key>.svg      -- the rendered image
+#   <key>.json                  -- the geometry tuple (width, height, depth)
+# where <key> is the sha256 hash of everything that affects the rendering.
+#
+# The geometry file is written after the image, so an entry is only considered
+# present once both files exist.
+#
+
+def cache_key(equation, fmt, dpi):
+    # The header is included so that changing the preamble invalidates the cache
+    text = '\n'.join([latex_header, equation.latex, str(equation.inline), fmt, str(dpi)])
+    return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+def cache_paths(equation, fmt, dpi):
+    key = cache_key(equation, fmt, dpi)
+    return (os.path.join(equation_cache_dir, key + '.' + fmt),
+            os.path.join(equation_cache_dir, key + '.json'))
+
+def get_image(equation, fmt):
+    if fmt == 'svg':
+        return equation.svg_path, equation.svg_geometry
+    else:
+        return equation.png_path, equation.png_geometry
+
+def set_image(equation, fmt, path, geometry):
+    if fmt == 'svg':
+        equation.svg_path = path
+        equation.svg_geometry = geometry
+    else:
+        equation.png_path = path
+        equation.png_geometry = geometry
+
+# Returns True if the equation was found in the cache
+def load_cached(equation, fmt, dpi):
+    image_path, geometry_path = cache_paths(equation, fmt, dpi)
+    if not (os.path.isfile(image_path) and os.path.isfile(geometry_path)):
+        return False
+
+    with open(geometry_path, 'r') as f:
+        geometry = tuple(json.load(f))
+    set_image(equation, fmt, image_path, geometry)
+    return True
+
+# Copies a freshly rendered image into the cache and points the equation at it.
+# Files are written under a temporary name and then renamed (see util.py), so
+# that a partially written entry is never visible.
+def store_cached(equation, fmt, dpi):
+    path, geometry = get_image(equation, fmt)
+    if path is None:
+        return
+
+    image_path, geometry_path = cache_paths(equation, fmt, dpi)
+    util.copy_atomic(path, image_path)
+    util.write_atomic(geometry_path, lambda f : json.dump(list(geometry), f))
+
+    set_image(equation, fmt, image_path, geometry)
+
+# Sets the svg_* and png_* fields of each equation, only running TeX on those
+# equations which are not already in the cache.
+def makeimages(equations, make_svg = False, make_png = True, png_dpi = 96):
+    formats = []
+    if make_svg:
+        formats.append(('svg', 0))
+    if make_png:
+        formats.append(('png', png_dpi))
+
+    missing = []
+    for equation in equations:
+        hit = True
+        for fmt, dpi in formats:
+            hit = load_cached(equation, fmt, dpi) and hit
+        if not hit:
+            missing.append(equation)
+
+    render(missing, make_svg = make_svg, make_png = make_png, png_dpi = png_dpi)
+
+    for equation in missing:
+        for fmt, dpi in formats:
+            store_cached(equation, fmt, dpi)
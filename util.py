@@ -1,6 +1,11 @@
+import os
+import shutil
+import hashlib
 import subprocess
 
-def call(cmd, **kwargs):
+# If report_errors is False, a failing command raises an exception without
+# printing its output first.
+def call(cmd, report_errors = True, **kwargs):
     # Other useful options:
     #   cwd = path-to-working-directory
     #   input = string-to-pass-as-stdin
@@ -15,11 +20,47 @@ def call(cmd, **kwargs):
     result = subprocess.run(cmd, **options)
 
     if result.returncode != 0:
-        print("Error in ", ' '.join(cmd))
-        print("***stdout:")
-        print(result.stdout)
-        print("***stderr:")
-        print(result.stderr)
+        if report_errors:
+            print("Error in ", ' '.join(cmd))
+            print("***stdout:")
+            print(result.stdout)
+            print("***stderr:")
+            print(result.stderr)
         result.check_returncode()
 
     return result
+
+# Feeds the contents of the file at path to the hash object h, a block at a
+# time, so that large files are not read into memory
+def hash_file(h, path):
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(1 << 16)
+            if len(block) == 0:
+                break
+            h.update(block)
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    hash_file(h, path)
+    return h.hexdigest()
+
+#
+# Files are written under a temporary name and then renamed, so that a partially
+# written file is never visible, even to other processes doing the same.
+#
+
+def temporary_path(path):
+    return path + '.tmp-{}'.format(os.getpid())
+
+# Calls write with the file opened in the given mode
+def write_atomic(path, write, mode = 'w'):
+    tmp = temporary_path(path)
+    with open(tmp, mode) as f:
+        write(f)
+    os.replace(tmp, path)
+
+def copy_atomic(source, path):
+    tmp = temporary_path(path)
+    shutil.copyfile(source, tmp)
+    os.replace(tmp, path)
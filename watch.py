@@ -0,0 +1,106 @@
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+#
+# Waiting for changes to the files in a directory tree, for watch mode. Both
+# kinds of notifier have a method
+#   wait(timeout)   -- blocks until something may have changed, or the timeout
+#                      (in seconds, None for no timeout) passes, and returns
+#                      whether something may have changed
+# Exactly what changed is worked out afterwards by scanning the tree (see
+# scan.py), so notifications do not need to be precise.
+#
+
+# IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+# IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+inotify_mask = 0x2 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+
+IN_MOVE_SELF = 0x800
+IN_IGNORED = 0x8000
+
+# struct inotify_event, which is followed by len bytes of name
+inotify_event = struct.Struct('iIII')
+
+# Uses inotify, which is only available on Linux
+class InotifyNotifier:
+    def __init__(self, root):
+        self.root = root
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        # Paths to watch descriptors and back
+        self.watched = {}
+        self.paths = {}
+        self.watch_directories()
+
+    # New directories need to be watched as they appear
+    def watch_directories(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if dirpath not in self.watched:
+                wd = self.libc.inotify_add_watch(self.fd,
+                        os.fsencode(dirpath), inotify_mask)
+                if wd >= 0:
+                    # The same directory under a new path, after its parent moved
+                    self.forget(wd)
+                    self.watched[dirpath] = wd
+                    self.paths[wd] = dirpath
+
+    # A directory which is deleted or moved away is no longer watched at its
+    # path, so it is forgotten, and watched again if the path is re-created
+    def forget(self, wd):
+        path = self.paths.pop(wd, None)
+        if path is not None and self.watched.get(path) == wd:
+            del self.watched[path]
+
+    def read_events(self):
+        data = os.read(self.fd, 1 << 16)
+        offset = 0
+        while offset + inotify_event.size <= len(data):
+            wd, mask, cookie, length = inotify_event.unpack_from(data, offset)
+            offset += inotify_event.size + length
+            if mask & IN_IGNORED:
+                self.forget(wd)
+            elif mask & IN_MOVE_SELF:
+                # The watch follows the directory to wherever it was moved
+                self.libc.inotify_rm_watch(self.fd, wd)
+                self.forget(wd)
+
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if len(ready) == 0:
+            return False
+        self.read_events()
+        self.watch_directories()
+        return True
+
+# Reports a possible change every interval seconds
+class PollingNotifier:
+    def __init__(self, root, interval = 1):
+        self.interval = interval
+
+    def wait(self, timeout):
+        if timeout is not None and timeout < self.interval:
+            time.sleep(timeout)
+            return False
+        time.sleep(self.interval)
+        return True
+
+def make_notifier(root):
+    try:
+        return InotifyNotifier(root)
+    except (OSError, AttributeError, TypeError):
+        print("inotify is not available, polling for changes instead")
+        return PollingNotifier(root)
+
+# Waits for a change, and then for the changes to stop for debounce seconds,
+# so that a burst of saves leads to a single rebuild
+def wait_for_changes(notifier, debounce = 0.3):
+    while not notifier.wait(None):
+        pass
+    while notifier.wait(debounce):
+        pass